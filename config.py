@@ -79,6 +79,13 @@ SEARCH_RESULTS = 20
 
 # info para el compresor / decompresor
 ARTICLES_PER_BLOCK = 2000
+# the articles of each block are compressed in frames of at least this size (in bytes), so
+# only one frame is decompressed to get an article; smaller frames are faster to read, but
+# they compress worse
+ARTICLES_FRAME_SIZE = 128 * 1024
+# Bytes of memory used to cache the most recently served articles, so the popular ones (the
+# portals, the featured articles) are not decompressed again in every request
+ARTICLES_CACHE_SIZE = 16 * 1024 ** 2
 DIR_PAGES_BLOCKS = "temp/pages"
 IMAGES_PER_BLOCK = 200
 DIR_IMAGES_BLOCKS = "temp/images"
@@ -89,6 +96,34 @@ DIR_TEMP = "temp"
 # Donde irán los archivos del índice
 DIR_INDICE = "temp/indice"
 
+# Codec used to compress the pages of documents in the index, and the quantity of documents
+# in each page: "lzma" and "lzma-extreme" get the smallest index, "zlib" or "raw" the
+# fastest (see CODECS in src/armado/sqlite_index.py)
+INDEX_CODEC = "lzma"
+INDEX_PAGE_SIZE = 512
+
+# Quantity of processes compressing the pages of documents of the index while it's built
+# (the result is the same with any quantity)
+INDEX_WORKERS = os.cpu_count() or 1
+
+# For server deployments (see SERVER_MODE) the index database can be mapped in memory and
+# read completely at startup, and its documents can also be preloaded decompressed, so the
+# searches never touch the disk (preloading implies mapping the database); CD/DVD editions
+# read it when needed, using less memory
+INDEX_MMAP = False
+INDEX_PRELOAD = False
+
+# Bytes of memory used by the index to cache the results of the recent searches, shared by
+# all the requests (the same words in any case or accents are the same search)
+INDEX_QUERY_CACHE_SIZE = 4 * 1024 ** 2
+
+# Budget of each search, so a too broad one (like a single letter) doesn't hold the server:
+# when it takes more seconds, or scores more articles, only the best results found so far
+# are shown (None to not limit it); the time is only limited in a server, as the CD/DVD
+# editions may read the index slowly from the disc
+INDEX_SEARCH_TIMEOUT = 1.0 if SERVER_MODE else None
+INDEX_SEARCH_MAX_SCORED = 100000
+
 # Directorio destino de los archivos preprocesados.
 DIR_PREPROCESADO = DIR_TEMP + "/preprocesado"
 
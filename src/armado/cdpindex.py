@@ -52,7 +52,10 @@ class IndexInterface(threading.Thread):
 
     def run(self):
         """Starts the index."""
-        self.index = Index(self.directory)
+        self.index = Index(self.directory, mmap=config.INDEX_MMAP, preload=config.INDEX_PRELOAD,
+                           cache_size=config.INDEX_QUERY_CACHE_SIZE,
+                           search_timeout=config.INDEX_SEARCH_TIMEOUT,
+                           search_max_scored=config.INDEX_SEARCH_MAX_SCORED)
         self.ready.set()
 
     def listado_words(self):
@@ -71,10 +74,20 @@ class IndexInterface(threading.Thread):
         value = self.index.random()
         return value
 
-    def search(self, words):
-        """Search whole words in the index."""
+    def search(self, words, offset=0, limit=None):
+        """Search whole words in the index, returning limit results from offset."""
         self.ready.wait()
-        return self.index.search(words)
+        return self.index.search(words, offset=offset, limit=limit)
+
+    def search_stats(self):
+        """Returns the counters of the searches cache, and of the truncated searches."""
+        self.ready.wait()
+        return self.index.search_stats()
+
+    def search_prefix(self, words, quantity):
+        """Search the best articles with a word starting with the last one."""
+        self.ready.wait()
+        return self.index.search_prefix(words, quantity)
 
 
 def tokenize(title):
@@ -146,6 +159,8 @@ def generate_from_html(dirbase, verbose):
         shutil.rmtree(config.DIR_INDICE)
     os.mkdir(config.DIR_INDICE)
 
-    Index.create(config.DIR_INDICE, gen())
+    Index.create(config.DIR_INDICE, gen(),
+                 codec=config.INDEX_CODEC, page_size=config.INDEX_PAGE_SIZE,
+                 workers=config.INDEX_WORKERS)
     logger.info("Index created at %s", config.DIR_INDICE)
     return len(top_pages)
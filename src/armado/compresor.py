@@ -27,15 +27,26 @@ Format of the block:
                  otherwise it's a (position, size) tuple
 
     - all the articles, smashed one after the other (origin 0 is after the header)
+
+The blocks of articles start with a magic, and their header also has the table of the
+frames in which the articles are compressed (see Comprimido).
+
+Besides the blocks, a locator file has where to find each item (see Locator), so it's not
+needed to load the headers of the blocks to get them.
 """
 
+import bisect
 import logging
 import lzma
+import mmap
 import os
 import pickle
 import struct
+import threading
 import urllib.parse
+from array import array
 from functools import lru_cache
+from hashlib import md5
 from lzma import LZMAFile as CompressedFile
 from os import path
 
@@ -52,6 +63,82 @@ logger = logging.getLogger(__name__)
 BLOCKS_CACHE_SIZE = 100
 
 
+def read_at(fh, lock, offset, size):
+    """Read from a position of a file shared by the server threads.
+
+    With positional reads the threads don't share the file cursor, so they don't wait for
+    each other; where they are not available (Windows) the lock serializes them.
+    """
+    if hasattr(os, "pread"):
+        return os.pread(fh.fileno(), size, offset)
+    with lock:
+        fh.seek(offset)
+        return fh.read(size)
+
+
+class Locator(object):
+    """Where to find each item in the blocks, from a memory mapped file.
+
+    The file has a magic, the quantity of items, the sorted hashes of the item names (as
+    unsigned 64 bits integers), and for each hash a record of unsigned 32 bits integers:
+    the number of the block, the offset and length of the data to read from the block
+    file, and the position and size of the item in that data once decoded (for the
+    articles it's the frame, which is decompressed). Redirects have the record of their
+    target. Names are not stored, a collision of the hashes is very unlikely.
+    """
+    FILENAME = "locator.bin"
+    MAGIC = b"CDPL"
+    RECORD_SIZE = 5
+
+    def __init__(self, fname):
+        with open(fname, "rb") as fh:
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError("Not a locator file: {!r}".format(fname))
+        (quantity,) = struct.unpack_from("<l", self.mmap, len(self.MAGIC))
+        view = memoryview(self.mmap)
+        hashes_start = len(self.MAGIC) + 4
+        records_start = hashes_start + quantity * 8
+        self.hashes = view[hashes_start:records_start].cast("Q")
+        self.records = view[records_start:].cast("I")
+
+    @staticmethod
+    def hash_name(name):
+        """Hash the name of an item, multiplatform as utiles.coherent_hash but bigger."""
+        return int.from_bytes(md5(name.encode("utf8")).digest()[:8], "little")
+
+    def find(self, name):
+        """Return the (block, offset, length, position, size) of the item, None if missing."""
+        key = self.hash_name(name)
+        idx = bisect.bisect_left(self.hashes, key)
+        if idx == len(self.hashes) or self.hashes[idx] != key:
+            return None
+        start = idx * self.RECORD_SIZE
+        return tuple(self.records[start:start + self.RECORD_SIZE])
+
+    @classmethod
+    def create(cls, fname, locations):
+        """Write the locator file from the locations of the items, by their name."""
+        by_hash = {}
+        for name, location in locations.items():
+            key = cls.hash_name(name)
+            if key in by_hash:
+                logger.warning("Ignoring item with a repeated hash in the locator: %r", name)
+                continue
+            by_hash[key] = location
+        hashes = array("Q", sorted(by_hash))
+        records = array("I")
+        for key in hashes:
+            records.extend(by_hash[key])
+
+        with open(fname, "wb") as fh:
+            fh.write(cls.MAGIC)
+            fh.write(struct.pack("<l", len(hashes)))
+            fh.write(hashes.tobytes())
+            fh.write(records.tobytes())
+        logger.debug("Locator saved in %s with %d items", fname, len(hashes))
+
+
 class BloqueManager(object):
     """Base class for the blockfiles handlers; not intended to be used directly.
 
@@ -69,6 +156,12 @@ class BloqueManager(object):
             self.num_bloques = int(fh.read().strip())
         self.verbose = verbose
 
+        # blocks built before the locator are found by the hash of the name, and their header
+        fname = os.path.join(self.archive_dir, Locator.FILENAME)
+        self.locator = Locator(fname) if os.path.exists(fname) else None
+        # the block files are shared by the server threads
+        self.lock = threading.Lock()
+
     @classmethod
     def _prep_archive_dir(cls, lang=None):
         """Prepare the directory for the archive."""
@@ -92,6 +185,11 @@ class BloqueManager(object):
         with open(fname, 'wt', encoding='ascii') as fh:
             fh.write(str(cant) + '\n')
 
+    @classmethod
+    def guardarLocator(cls, locations):
+        """Save to disk the locator of the items, by their name."""
+        Locator.create(os.path.join(cls.archive_dir, Locator.FILENAME), locations)
+
     @lru_cache(BLOCKS_CACHE_SIZE)  # This LRU is shared between inherited managers
     def getBloque(self, nombre):
         """Get the block for a given name."""
@@ -99,16 +197,40 @@ class BloqueManager(object):
         logger.debug("block opened from file: %s", nombre)
         return comp
 
+    @lru_cache(BLOCKS_CACHE_SIZE)  # This LRU is shared between inherited managers
+    def _open_block_file(self, nombre):
+        """Open the file of a block, without loading its header."""
+        return open(os.path.join(self.archive_dir, nombre), "rb")
+
     def get_item(self, fileName):
         """Get the item from inside of a block."""
-        bloqNum = utiles.coherent_hash(fileName.encode('utf8')) % self.num_bloques
-        bloqName = "%08x%s" % (bloqNum, self.archive_extension)
-        logger.debug("block: %s", bloqName)
-        comp = self.getBloque(bloqName)
-        item = comp.get_item(fileName)
+        if self.locator is not None:
+            item = self._get_located_item(fileName)
+        else:
+            bloqNum = utiles.coherent_hash(fileName.encode('utf8')) % self.num_bloques
+            bloqName = "%08x%s" % (bloqNum, self.archive_extension)
+            logger.debug("block: %s", bloqName)
+            comp = self.getBloque(bloqName)
+            item = comp.get_item(fileName)
         logger.debug("len item: %s", None if item is None else len(item))
         return item
 
+    def _get_located_item(self, fileName):
+        """Get the item reading only its data from the block, as found in the locator."""
+        location = self.locator.find(fileName)
+        logger.debug("location: %s", location)
+        if location is None:
+            return None
+
+        return self._read_location(location)
+
+    def _read_location(self, location):
+        """Read the item from the location given by the locator."""
+        bloqNum, offset, length, position, size = location
+        fh = self._open_block_file("%08x%s" % (bloqNum, self.archive_extension))
+        data = read_at(fh, self.lock, offset, length)
+        return self.archive_class.decode(data, position, size)
+
 
 class Bloque(object):
     """Common functionality for a block."""
@@ -126,10 +248,18 @@ class Bloque(object):
             data = self.manager.get_item(info)
         else:
             (seek, size) = info
-            self.fh.seek(4 + self.header_size + seek)
-            data = self.fh.read(size)
+            data = self._read(seek, size)
         return data
 
+    def _read(self, seek, size):
+        """Read the data of an item, from its position after the header."""
+        return read_at(self.fh, self.lock, 4 + self.header_size + seek, size)
+
+    @classmethod
+    def decode(cls, data, position, size):
+        """Get an item from the data read from the block file."""
+        return data[position:position + size]
+
     def close(self):
         """Cleanup."""
         if hasattr(self, "fh"):
@@ -148,6 +278,8 @@ class BloqueImagenes(Bloque):
             self.header_size = struct.unpack("<l", self.fh.read(4))[0]
             header_bytes = self.fh.read(self.header_size)
             self.header = pickle.loads(lzma.decompress(header_bytes))
+            # the file is shared by the server threads
+            self.lock = threading.Lock()
         else:
             # no need to define self.fh or self.header_size because will never be
             # used, as no item will be found in the empty header
@@ -157,7 +289,7 @@ class BloqueImagenes(Bloque):
 
     @classmethod
     def crear(cls, bloqNum, fileNames, verbose=False):
-        """Generate the file."""
+        """Generate the file, returning the locations of the images in it."""
         logger.debug("Processing block of images %s", bloqNum)
 
         header = {}
@@ -191,19 +323,44 @@ class BloqueImagenes(Bloque):
                 with open(fullName, "rb") as src_fh:
                     dst_fh.write(src_fh.read())
 
+        images_start = 4 + len(headerBytes)
+        return {fileName: (images_start + seek, size, 0, size)
+                for fileName, (seek, size) in header.items()}
+
 
 class Comprimido(Bloque):
     """A block of articles.
 
-    Here everything is compressed together.
+    The articles are compressed in frames of a few of them, so getting one only needs
+    to decompress the start of its frame. After FRAMES_MAGIC and the header length, the
+    header is compressed with lzma, and besides the dict of the files it has the table of
+    the frames: the position of the first article of each frame (in all the articles
+    smashed uncompressed, as in the dict), and the offset of its compressed data after
+    the header (plus the end of the last frame). Then the frames follow, in raw lzma2.
+
+    Older blocks have everything compressed together in a lzma file, so an article is
+    decompressed along with all the previous ones in the block.
     """
+    FRAMES_MAGIC = b"CDPF"
+    FRAME_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": 2 ** 20}]
 
     def __init__(self, fname, verbose=False, manager=None):
+        self.frame_starts = None
         if os.path.exists(fname):
-            self.fh = CompressedFile(fname, "rb")
-            self.header_size = struct.unpack("<l", self.fh.read(4))[0]
-            header_bytes = self.fh.read(self.header_size)
-            self.header = pickle.loads(header_bytes)
+            self.fh = open(fname, "rb")
+            if self.fh.read(len(self.FRAMES_MAGIC)) == self.FRAMES_MAGIC:
+                self.header_size = struct.unpack("<l", self.fh.read(4))[0]
+                header_bytes = lzma.decompress(self.fh.read(self.header_size))
+                self.header, self.frame_starts, self.frame_offsets = pickle.loads(header_bytes)
+                self.frames_start = len(self.FRAMES_MAGIC) + 4 + self.header_size
+            else:
+                self.fh.close()
+                self.fh = CompressedFile(fname, "rb")
+                self.header_size = struct.unpack("<l", self.fh.read(4))[0]
+                header_bytes = self.fh.read(self.header_size)
+                self.header = pickle.loads(header_bytes)
+            # the file is shared by the server threads
+            self.lock = threading.Lock()
         else:
             # no need to define self.fh or self.header_size because will never be
             # used, as no item will be found in the empty header
@@ -211,45 +368,100 @@ class Comprimido(Bloque):
         self.verbose = verbose
         self.manager = manager
 
+    def _read(self, seek, size):
+        """Read the data of an article, decompressing only its frame up to it."""
+        if self.frame_starts is None:
+            # the decompressed stream has a single cursor, the threads must wait their turn
+            with self.lock:
+                self.fh.seek(4 + self.header_size + seek)
+                return self.fh.read(size)
+
+        frame = bisect.bisect_right(self.frame_starts, seek) - 1
+        start, end = self.frame_offsets[frame], self.frame_offsets[frame + 1]
+        compressed = read_at(self.fh, self.lock, self.frames_start + start, end - start)
+        return self.decode(compressed, seek - self.frame_starts[frame], size)
+
+    @classmethod
+    def decode(cls, data, position, size):
+        """Get an article decompressing its frame, only up to the article's end."""
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=cls.FRAME_FILTERS)
+        data = decompressor.decompress(data, max_length=position + size)
+        return data[position:]
+
     @classmethod
     def crear(cls, redirects, bloqNum, top_filenames, verbose=False):
-        """Generate the compressed file."""
+        """Generate the compressed file, returning the locations of the articles in it."""
         logger.debug("Processing block %s", bloqNum)
 
         header = {}
-
-        # fill the header with real file info, with the page as key, and the position/size as value
+        frame_starts = []
+        frame_offsets = [0]
+        frames = []
+        frame = []
+
+        def compress_frame():
+            """Compress the articles of the frame together."""
+            data = lzma.compress(b"".join(frame), lzma.FORMAT_RAW, filters=cls.FRAME_FILTERS)
+            frames.append(data)
+            frame_offsets.append(frame_offsets[-1] + len(data))
+            frame.clear()
+
+        # fill the header with real file info, with the page as key, and the position/size as
+        # value; the articles are grouped in frames of at least ARTICLES_FRAME_SIZE bytes
         seek = 0
+        frame_size = 0
         for dir3, filename in top_filenames:
             fullName = path.join(config.DIR_PAGSLISTAS, dir3, filename)
-            size = path.getsize(fullName)
-            header[filename] = (seek, size)
-            seek += size
+            with open(fullName, "rb") as src_fh:
+                article = src_fh.read()
+            if not frame:
+                frame_starts.append(seek)
+                frame_size = 0
+            header[filename] = (seek, len(article))
+            frame.append(article)
+            seek += len(article)
+            frame_size += len(article)
+            if frame_size >= config.ARTICLES_FRAME_SIZE:
+                compress_frame()
+        if frame:
+            compress_frame()
 
         # put also in the header the redirects, being the value the page that is destination of
         # the redirection
         for orig, dest in redirects:
             header[orig] = dest
 
-        headerBytes = pickle.dumps(header)
+        headerBytes = lzma.compress(pickle.dumps((header, frame_starts, frame_offsets)))
         logger.debug(
-            "  files: %d   total seek: %d   header length: %d",
-            len(top_filenames), seek, len(headerBytes))
+            "  files: %d   total seek: %d   frames: %d   header length: %d",
+            len(top_filenames), seek, len(frames), len(headerBytes))
 
-        # open the compressed file
+        # open the file to compress
         nomfile = path.join(config.DIR_PAGES_BLOCKS, "%08x.cdp" % bloqNum)
         logger.debug("  saving in %s", nomfile)
 
-        with CompressedFile(nomfile, "wb") as dst_fh:
-            # save the header length, and the header itself
+        with open(nomfile, "wb") as dst_fh:
+            # save the magic, the header length, and the header itself
+            dst_fh.write(cls.FRAMES_MAGIC)
             dst_fh.write(struct.pack("<l", len(headerBytes)))
             dst_fh.write(headerBytes)
 
-            # save each of the articles
-            for dir3, filename in top_filenames:
-                fullName = path.join(config.DIR_PAGSLISTAS, dir3, filename)
-                with open(fullName, "rb") as src_fh:
-                    dst_fh.write(src_fh.read())
+            # save each of the frames
+            for data in frames:
+                dst_fh.write(data)
+
+        # the articles are found by their frame, as it's after the header
+        frames_start = len(cls.FRAMES_MAGIC) + 4 + len(headerBytes)
+        locations = {}
+        for filename, info in header.items():
+            if isinstance(info, str):
+                continue
+            seek, size = info
+            frame = bisect.bisect_right(frame_starts, seek) - 1
+            start, end = frame_offsets[frame], frame_offsets[frame + 1]
+            locations[filename] = (frames_start + start, end - start, seek - frame_starts[frame],
+                                   size)
+        return locations
 
 
 class ArticleManager(BloqueManager):
@@ -258,6 +470,11 @@ class ArticleManager(BloqueManager):
     archive_class = Comprimido
     items_per_block = config.ARTICLES_PER_BLOCK
 
+    def __init__(self, verbose=False, cache_size=0):
+        super(ArticleManager, self).__init__(verbose)
+        # the articles' utf8 bytes, by their location or, without locator, by their name
+        self.cache = utiles.SizedLRUCache(cache_size)
+
     @classmethod
     def generar_bloques(cls, lang, verbose):
         cls._prep_archive_dir(lang)
@@ -303,16 +520,46 @@ class ArticleManager(BloqueManager):
         # build each of the compressed blocks
         tot_archs = 0
         tot_redirs = 0
+        locations = {}
         for bloqNum, fileNames in bloques.items():
             tot_archs += len(fileNames)
             redirs_thisblock = redirects.get(bloqNum, [])
             tot_redirs += len(redirs_thisblock)
-            Comprimido.crear(redirs_thisblock, bloqNum, fileNames, verbose)
+            for filename, location in Comprimido.crear(
+                    redirs_thisblock, bloqNum, fileNames, verbose).items():
+                locations[filename] = (bloqNum,) + location
+
+        # the redirects are located directly where their target is
+        for redirs_thisblock in redirects.values():
+            for orig, dest_filename in redirs_thisblock:
+                if dest_filename in locations:
+                    locations[orig] = locations[dest_filename]
+        cls.guardarLocator(locations)
 
         return (len(bloques), tot_archs, tot_redirs)
 
+    def _get_located_item(self, fileName):
+        """Get the article, cached by its location so a redirect shares its target's."""
+        location = self.locator.find(fileName)
+        if location is None:
+            return None
+        article = self.cache.get(location)
+        if article is None:
+            article = self._read_location(location)
+            self.cache.put(location, article)
+        return article
+
     def get_item(self, name):
-        article = super(ArticleManager, self).get_item(name)
+        if self.locator is not None:
+            article = super(ArticleManager, self).get_item(name)
+        else:
+            # the redirects get their target from this same method, so they are decoded
+            # here, and only the target is cached
+            article = self.cache.get(name)
+            if article is None:
+                article = super(ArticleManager, self).get_item(name)
+                if isinstance(article, bytes):
+                    self.cache.put(name, article)
 
         # check for unicode before decoding, as we may be here twice in
         # the case of articles that are redirects to others (so, let's avoid
@@ -350,8 +597,35 @@ class ImageManager(BloqueManager):
             logger.debug("  files: %s %r", bloqNum, fileName)
 
         tot = 0
+        locations = {}
         for bloqNum, fileNames in bloques.items():
             tot += len(fileNames)
-            BloqueImagenes.crear(bloqNum, fileNames, verbose)
+            for fileName, location in BloqueImagenes.crear(bloqNum, fileNames, verbose).items():
+                locations[fileName] = (bloqNum,) + location
+        cls.guardarLocator(locations)
 
         return (len(bloques), tot)
+
+    @lru_cache(BLOCKS_CACHE_SIZE)
+    def _map_block_file(self, nombre):
+        """Map the file of a block in memory, to get views of its images."""
+        with open(os.path.join(self.archive_dir, nombre), "rb") as fh:
+            return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def get_item_view(self, fileName):
+        """Get the image as a view of its memory mapped block, so it's not read nor copied."""
+        if self.locator is not None:
+            location = self.locator.find(fileName)
+            if location is None:
+                return None
+            bloqNum, offset, _, position, size = location
+            start = offset + position
+        else:
+            bloqNum = utiles.coherent_hash(fileName.encode('utf8')) % self.num_bloques
+            comp = self.getBloque("%08x%s" % (bloqNum, self.archive_extension))
+            if fileName not in comp.header:
+                return None
+            seek, size = comp.header[fileName]
+            start = 4 + comp.header_size + seek
+        view = self._map_block_file("%08x%s" % (bloqNum, self.archive_extension))
+        return view[start:start + size]
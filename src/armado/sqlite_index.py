@@ -16,24 +16,90 @@
 
 
 import array
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import itertools
 import logging
+import lzma
 import math
 import operator
 import os
 import pickle
+import queue
 import random
+import re
 import unicodedata
 import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 from collections import defaultdict
+from contextlib import contextmanager
 from functools import lru_cache
-import lzma as best_compressor  # zlib is faster, lzma has better ratio.
 
 from src.armado import to3dirs
+from src.utiles import SizedLRUCache
+
+try:
+    import resource
+except ImportError:
+    # not available in Windows
+    resource = None
 
 logger = logging.getLogger(__name__)
 
 PAGE_SIZE = 512
+# version of the index format, stored in its metadata (older indexes have none); since
+# version 2 the tokens are clustered by word, and the n-grams point to their tokenid
+FORMAT_VERSION = 2
 MAX_RESULTS = 500
+NGRAM_SIZE = 3
+# misspelled words are corrected up to one edit if shorter than FUZZY_LONG_WORD, else up to
+# two; shorter words than FUZZY_MIN_WORD are not corrected nor stored for corrections
+FUZZY_MIN_WORD = 3
+FUZZY_LONG_WORD = 5
+# quantity of articles, and of words positions, kept in memory when building the index
+# before spilling them sorted to temporary files
+SORT_RUN_SIZE = 100000
+TOKENS_RUN_SIZE = 5000000
+DELETES_RUN_SIZE = 5000000
+# quantity of idle connections kept by the index to serve concurrent requests
+POOL_SIZE = 8
+# bytes of memory used to cache the docids found by the recent searches
+QUERY_CACHE_SIZE = 4 * 1024 ** 2
+# quantity of SQLite virtual machine instructions between the checks of the search deadline
+PROGRESS_STEPS = 10000
+# quantity of scored docs between the checks of the search deadline
+DEADLINE_CHECK_INTERVAL = 64
+# max quantity of sql variables used in a single query
+SQL_VARS_LIMIT = 500
+# minimum size ratio between two docids sequences to intersect them galloping
+GALLOPING_RATIO = 8
+# quantity of docids between the skip entries of a docset
+SKIP_INTERVAL = 128
+
+# the codecs to compress the docs pages, as (compress, decompress); zlib is faster,
+# lzma has better ratio
+CODECS = {
+    'lzma': (lzma.compress, lzma.decompress),
+    'lzma-fast': (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+    'lzma-extreme': (lambda data: lzma.compress(data, preset=9 | lzma.PRESET_EXTREME),
+                     lzma.decompress),
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'raw': (bytes, bytes),
+}
+DEFAULT_CODEC = 'lzma'
+
+# minimum size of an encoded bucket to try to decode it mostly in C
+DECODE_IN_C_MIN_SIZE = 64
+# a number that is encoded in more than one byte, and the bytes of one byte numbers
+_MULTIBYTE_NUMBER = re.compile(b'[\x80-\xff]+[\x00-\x7f]')
+_ONE_BYTE_NUMBERS = bytes(range(0x80))
 
 
 class IndexEntry:
@@ -66,6 +132,78 @@ class IndexEntry:
         return hash(tuple(getattr(self, attr) for attr in self.__slots__))
 
 
+class DocsPage:
+    """Compact binary layout of a page of documents, to decode them one by one.
+
+    The page starts with the quantity of records and the offset of each one (plus the
+    end of the last one), all of them unsigned ints of 4 bytes, followed by the records.
+    Each record has a fixed head with the type, score and original docid, and the
+    lengths of the link, title, description and subtitle (NONE_LENGTH for None), that
+    follow it encoded in UTF-8.
+    """
+    UINT = struct.Struct('<I')
+    HEAD = struct.Struct('<BqIIIII')
+    NONE_LENGTH = 0xFFFFFFFF
+    FIELDS = ('link', 'title', 'description', 'subtitle')
+
+    @classmethod
+    def encode(cls, entries):
+        """Encode the index entries into a page."""
+        records = []
+        offsets = [0]
+        for entry in entries:
+            values = [getattr(entry, field) for field in cls.FIELDS]
+            values = [value if value is None else value.encode("utf8") for value in values]
+            lengths = [cls.NONE_LENGTH if value is None else len(value) for value in values]
+            record = cls.HEAD.pack(entry.rtype, entry.score, entry.orig_docid, *lengths)
+            record += b"".join(value for value in values if value is not None)
+            records.append(record)
+            offsets.append(offsets[-1] + len(record))
+
+        header_size = cls.UINT.size * (len(entries) + 2)
+        header = struct.pack("<{}I".format(len(offsets) + 1), len(entries),
+                             *(offset + header_size for offset in offsets))
+        return header + b"".join(records)
+
+    @classmethod
+    def length(cls, page):
+        """Return the quantity of records in the page."""
+        return cls.UINT.unpack_from(page)[0]
+
+    @classmethod
+    def decode(cls, page, position):
+        """Decode only the index entry in that position of the page."""
+        if not 0 <= position < cls.length(page):
+            raise IndexError("Non existing record in page")
+        offset, = cls.UINT.unpack_from(page, cls.UINT.size * (position + 1))
+        rtype, score, orig_docid, *lengths = cls.HEAD.unpack_from(page, offset)
+        offset += cls.HEAD.size
+        values = []
+        for length in lengths:
+            if length == cls.NONE_LENGTH:
+                values.append(None)
+            else:
+                values.append(page[offset:offset + length].decode("utf8"))
+                offset += length
+        link, title, description, subtitle = values
+        return IndexEntry(rtype=rtype, link=link, title=title, score=score,
+                          description=description, subtitle=subtitle, orig_docid=orig_docid)
+
+    @classmethod
+    def decode_origin(cls, page, position):
+        """Decode only the type and the original docid of the record in that position."""
+        if not 0 <= position < cls.length(page):
+            raise IndexError("Non existing record in page")
+        offset, = cls.UINT.unpack_from(page, cls.UINT.size * (position + 1))
+        rtype, _, orig_docid = cls.HEAD.unpack_from(page, offset)[:3]
+        return rtype, orig_docid
+
+    @classmethod
+    def decode_all(cls, page):
+        """Decode all the index entries of the page."""
+        return [cls.decode(page, position) for position in range(cls.length(page))]
+
+
 # cache for normalized chars
 _normalized_chars = {}
 
@@ -93,13 +231,79 @@ def normalize_words(txt):
     return ''.join(txt_norm)
 
 
+def get_ngrams(word):
+    """Return the set of n-grams of a word.
+
+    Words shorter than NGRAM_SIZE are its own (and only) n-gram, so every substring of
+    at most NGRAM_SIZE chars of any word is contained in one of the word's n-grams.
+    """
+    if len(word) <= NGRAM_SIZE:
+        return {word}
+    return {word[i:i + NGRAM_SIZE] for i in range(len(word) - NGRAM_SIZE + 1)}
+
+
+def get_deletes(word):
+    """Return the set of variants of a word, with one of its chars deleted."""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def hash_variant(variant):
+    """Return the hash that is stored for a variant of a word (they may collide)."""
+    return zlib.crc32(variant.encode("utf8"))
+
+
+def edit_distance(word1, word2):
+    """Return the edit distance between two words, where a transposition is one edit."""
+    rows = [list(range(len(word2) + 1))]
+    for i, char1 in enumerate(word1, 1):
+        row = [i]
+        for j, char2 in enumerate(word2, 1):
+            distance = min(rows[-1][j] + 1, row[j - 1] + 1, rows[-1][j - 1] + (char1 != char2))
+            if i > 1 and j > 1 and char1 == word2[j - 2] and word1[i - 2] == char2:
+                distance = min(distance, rows[-2][j - 2] + 1)
+            row.append(distance)
+        rows.append(row)
+    return rows[-1][-1]
+
+
+def intersect_sorted(docids1, docids2):
+    """Intersect two sorted sequences of unique docids, returning a sorted list.
+
+    When one of them is way bigger, the smaller is walked galloping over the bigger one.
+    """
+    if len(docids1) > len(docids2):
+        docids1, docids2 = docids2, docids1
+    if len(docids2) < GALLOPING_RATIO * len(docids1):
+        return sorted(set(docids1).intersection(docids2))
+
+    result = []
+    lo = 0
+    size = len(docids2)
+    for docid in docids1:
+        # find exponentially an upper limit for the docid, then bisect
+        step = 1
+        hi = lo + 1
+        while hi < size and docids2[hi] < docid:
+            lo = hi
+            step *= 2
+            hi = lo + step
+        lo = bisect.bisect_left(docids2, docid, lo, min(hi, size))
+        if lo == size:
+            break
+        if docids2[lo] == docid:
+            result.append(docid)
+    return result
+
+
 def decompress_data(data):
-    return pickle.loads(best_compressor.decompress(data))
+    return pickle.loads(lzma.decompress(data))
 
 
 class DocSet:
     """Data type to encode, decode & compute documents-id's sets."""
     SEPARATOR = 0xFF
+    # encoded docsets with skips start with the separator and this version
+    SKIPS_VERSION = 1
 
     def __init__(self):
         self._docs_list = defaultdict(list)
@@ -154,25 +358,50 @@ class DocSet:
         - ctor is the final container
         - append is the callable attribute used to add an element into the ctor
         """
-        result = []
-        add_to_result = result.append
-
-        prev_doc = doc = shift = 0
-
-        for b in ordered:
-            doc |= (b & 0x7F) << shift
-            shift += 7
-
-            if not (b & 0x80):
-                # the sequence ended
-                prev_doc += doc
-                add_to_result(prev_doc)
-                doc = shift = 0
-
-        return result
+        # only big buckets where most of the deltas fit in one byte are worth decoding in C
+        dense = len(ordered) >= DECODE_IN_C_MIN_SIZE
+        if dense:
+            dense = len(ordered.translate(None, _ONE_BYTE_NUMBERS)) * 8 < len(ordered)
+        if not dense:
+            result = []
+            add_to_result = result.append
+
+            prev_doc = doc = shift = 0
+
+            for b in ordered:
+                doc |= (b & 0x7F) << shift
+                shift += 7
+
+                if not (b & 0x80):
+                    # the sequence ended
+                    prev_doc += doc
+                    add_to_result(prev_doc)
+                    doc = shift = 0
+
+            return result
+
+        # only the numbers encoded in several bytes are decoded by hand, the rest of
+        # the deltas are copied and accumulated in C
+        deltas = []
+        prev_end = 0
+        for match in _MULTIBYTE_NUMBER.finditer(ordered):
+            start, end = match.span()
+            deltas.extend(ordered[prev_end:start])
+            doc = shift = 0
+            for b in ordered[start:end]:
+                doc |= (b & 0x7F) << shift
+                shift += 7
+            deltas.append(doc)
+            prev_end = end
+        deltas.extend(ordered[prev_end:])
+        return list(itertools.accumulate(deltas))
 
     def encode(self):
-        """Encode to store compressed inside the database."""
+        """Encode to store compressed inside the database.
+
+        Docsets with more than SKIP_INTERVAL docids are encoded with a table of skips, so
+        they can be probed without decoding all of them (see `probe`).
+        """
         if not self._docs_list:
             return ""
         docs_list = []
@@ -180,24 +409,155 @@ class DocSet:
             docs_list.extend((key, value) for value in values)
         docs_list.sort()
         docs = [v[0] for v in docs_list]
-        docs_enc = DocSet.delta_encode(docs)
         # if any score is greater than 255 or lesser than 1, it won't work
         position = [v[1] for v in docs_list]
         if any([x >= self.SEPARATOR for x in position]):
             raise ValueError("Positions can't be greater than 254.")
         position.append(self.SEPARATOR)
         position = array.array("B", position)
-        return position.tobytes() + docs_enc
+        if len(docs) <= SKIP_INTERVAL:
+            return position.tobytes() + DocSet.delta_encode(docs)
+
+        # the docids are still delta encoded all along, the skips just point inside them
+        chunks = []
+        skips = []
+        size = 0
+        prev_doc = 0
+        for start in range(0, len(docs), SKIP_INTERVAL):
+            block = docs[start:start + SKIP_INTERVAL]
+            if start:
+                first_size = len(DocSet.delta_encode([block[0] - prev_doc]))
+                skips.extend((block[0], size + first_size))
+            chunk = DocSet.delta_encode([doc - prev_doc for doc in block])
+            chunks.append(chunk)
+            size += len(chunk)
+            prev_doc = block[-1]
+        header = bytes((self.SEPARATOR, self.SKIPS_VERSION))
+        skips_table = struct.pack('<{}I'.format(len(skips) + 1), len(skips) // 2, *skips)
+        return header + position.tobytes() + skips_table + b"".join(chunks)
+
+    @classmethod
+    def _layout(cls, encoded):
+        """Return where the positions end and the docids start, and the docset skips.
+
+        The skips are the docids and the offsets (from the docids start) of the number
+        after them, every SKIP_INTERVAL docids; the old format has no header nor skips.
+        """
+        if encoded[0] != cls.SEPARATOR:
+            limit = encoded.index(cls.SEPARATOR)
+            return 0, limit, limit + 1, (), ()
+        if encoded[1] != cls.SKIPS_VERSION:
+            raise ValueError("Unknown docset format: {}".format(encoded[1]))
+        limit = encoded.index(cls.SEPARATOR, 2)
+        quant, = struct.unpack_from('<I', encoded, limit + 1)
+        skips = struct.unpack_from('<{}I'.format(quant * 2), encoded, limit + 5)
+        return 2, limit, limit + 5 + quant * 8, skips[0::2], skips[1::2]
+
+    @classmethod
+    def has_skips(cls, encoded):
+        """Tell if the encoded docset has skips to probe it."""
+        return len(encoded) > 1 and encoded[0] == cls.SEPARATOR
+
+    @classmethod
+    def probe(cls, encoded, candidates):
+        """Return which of the sorted candidates are in the docset, jumping over it.
+
+        Only the blocks of docids that may hold a candidate are decoded.
+        """
+        _, _, docids_start, skip_docids, skip_offsets = cls._layout(encoded)
+        found = []
+        current = None
+        for candidate in candidates:
+            # the candidate can only be between the last skip before it and the next one
+            block = bisect.bisect_left(skip_docids, candidate)
+            if block != current:
+                current = block
+                if block:
+                    base = skip_docids[block - 1]
+                    start = docids_start + skip_offsets[block - 1]
+                else:
+                    base = 0
+                    start = docids_start
+                if block < len(skip_offsets):
+                    end = docids_start + skip_offsets[block]
+                else:
+                    end = len(encoded)
+                # the docids of the block, minus the base
+                deltas = cls.delta_decode(encoded[start:end])
+            delta = candidate - base
+            idx = bisect.bisect_left(deltas, delta)
+            if idx < len(deltas) and deltas[idx] == delta:
+                found.append(candidate)
+        return found
+
+    @classmethod
+    def decode_docids(cls, encoded):
+        """Decode only the docids of a compressed docset (in order, repeated by position)."""
+        if len(encoded) > 1:
+            if encoded[0] == cls.SEPARATOR:
+                docids_start = cls._layout(encoded)[2]
+            else:
+                docids_start = encoded.index(cls.SEPARATOR) + 1
+            return cls.delta_decode(encoded[docids_start:])
+        return []
+
+    @classmethod
+    def first_docids(cls, encoded, quantity, below=None):
+        """Decode only the first quantity of different docids of a compressed docset.
+
+        If the docset starts with a docid that is not below the given one, nothing is decoded.
+        """
+        if len(encoded) <= 1:
+            return []
+        if encoded[0] == cls.SEPARATOR:
+            docids_start = cls._layout(encoded)[2]
+        else:
+            docids_start = encoded.index(cls.SEPARATOR) + 1
+        if below is not None and cls.decode_varint(encoded, docids_start)[0] >= below:
+            return []
+        # no docid delta takes more than 5 bytes, but a docid may be repeated by position
+        size = quantity * 5
+        while True:
+            end = min(len(encoded), docids_start + size)
+            # cut after the last complete number
+            while end > docids_start and encoded[end - 1] & 0x80:
+                end -= 1
+            docids = sorted(set(cls.delta_decode(encoded[docids_start:end])))
+            if len(docids) >= quantity or end == len(encoded):
+                return docids[:quantity]
+            size *= 2
+
+    @staticmethod
+    def decode_varint(encoded, offset):
+        """Decode the number that starts in the offset, return it and the next offset."""
+        value = shift = 0
+        while True:
+            b = encoded[offset]
+            offset += 1
+            value |= (b & 0x7F) << shift
+            shift += 7
+            if not (b & 0x80):
+                return value, offset
+
+    @classmethod
+    def decode_arrays(cls, encoded):
+        """Decode a compressed docset into arrays of sorted docids and their positions."""
+        if len(encoded) > 1:
+            positions_start, limit, docids_start, _, _ = cls._layout(encoded)
+            docids = array.array('L', cls.delta_decode(encoded[docids_start:]))
+            positions = array.array('B', encoded[positions_start:limit])
+            return docids, positions
+        return array.array('L'), array.array('B')
 
     @classmethod
     def decode(cls, encoded):
         """Decode a compressed docset."""
         docset = cls()
         if len(encoded) > 1:
-            limit = encoded.index(cls.SEPARATOR)
-            docsid = cls.delta_decode(encoded[limit + 1:])
+            positions_start, limit, docids_start, _, _ = cls._layout(encoded)
+            docsid = cls.delta_decode(encoded[docids_start:])
             positions = array.array('B')
-            positions.frombytes(encoded[:limit])
+            positions.frombytes(encoded[positions_start:limit])
             for docid, position in zip(docsid, positions):
                 docset._docs_list[docid].append(position)
         return docset
@@ -219,6 +579,187 @@ def open_connection(filename):
     return con
 
 
+def peak_rss():
+    """Return the peak of resident memory used by the process, in MB (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # it's in bytes in macOS, and in KB in Linux
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return round(peak / 1024, 1)
+
+
+def _compress_docs_page(codec, page_id, word_quants, page):
+    """Compress the encoded page of docs, returning its row."""
+    return [(page_id, word_quants, CODECS[codec][0](page))]
+
+
+def _write_run(items, directory):
+    """Pickle the items in a temporary file, and return it ready to be read."""
+    fh = tempfile.TemporaryFile(dir=directory)
+    for item in items:
+        pickle.dump(item, fh, pickle.HIGHEST_PROTOCOL)
+    fh.seek(0)
+    return fh
+
+
+def _read_run(fh):
+    """Yield the items pickled in the temporary file, and close it."""
+    with fh:
+        while True:
+            try:
+                yield pickle.load(fh)
+            except EOFError:
+                return
+
+
+def external_sort(items, directory, run_size=SORT_RUN_SIZE, key=None, reverse=False):
+    """Sort the items as `sorted`, but keeping at most run_size of them in memory.
+
+    The items are sorted by runs that are spilled to temporary files in the directory,
+    and then merged. Return the quantity of items and an iterator over them.
+    """
+    items = iter(items)
+    runs = []
+    quantity = 0
+    while True:
+        run = sorted(itertools.islice(items, run_size), key=key, reverse=reverse)
+        quantity += len(run)
+        if len(run) < run_size and not runs:
+            # all fitted in memory
+            return quantity, iter(run)
+        if run:
+            runs.append(_write_run(run, directory))
+        if len(run) < run_size:
+            break
+    return quantity, heapq.merge(*map(_read_run, runs), key=key, reverse=reverse)
+
+
+class FetchedRows:
+    """The rows of an already executed query, to be read as from a cursor."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class ConnectionPool:
+    """A pool of connections to a database, to be shared among threads.
+
+    Each query is run in a connection that is not used by other thread meanwhile; new
+    connections are opened when all are in use, and closed if there are already `size`
+    idle ones. The script is run in every new connection, to set it up.
+    """
+
+    def __init__(self, filename, script, size=POOL_SIZE):
+        self.filename = filename
+        self.script = script
+        self._idle = queue.LifoQueue(size)
+
+    @contextmanager
+    def connection(self):
+        """Get a connection for exclusive use of the caller meanwhile."""
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            con = open_connection(self.filename)
+            con.executescript(self.script)
+        try:
+            yield con
+        finally:
+            try:
+                self._idle.put_nowait(con)
+            except queue.Full:
+                con.close()
+
+    def execute(self, sql, parameters=()):
+        """Run the query in some connection, and return all its rows."""
+        with self.connection() as con:
+            return FetchedRows(con.execute(sql, parameters).fetchall())
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SearchResults:
+    """Iterator over the values of a page of the results of a search.
+
+    The total is the quantity of results of all the pages. If the search exceeded its time
+    or work budget it's truncated, and only the best results found until then are given.
+    """
+
+    def __init__(self, values=(), total=None, truncated=False):
+        self.values = iter(values)
+        self.total = len(values) if total is None else total
+        self.truncated = truncated
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.values)
+
+
+class QueryCache(SizedLRUCache):
+    """Cache of the docids found for the searched keys, bounded by its size in bytes.
+
+    The docids of each search are kept packed as immutable bytes, with the flag of the
+    search being truncated, and the least recently used searches are evicted when the
+    size is exceeded.
+    """
+    DOCIDS = 'I'
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        super().__init__(size)
+
+    def _entry_size(self, keys, value):
+        """Return the approximate bytes of memory used by the entry, with its keys."""
+        packed, _ = value
+        return super()._entry_size(keys, packed) + sum(map(sys.getsizeof, keys))
+
+    def get(self, keys):
+        """Return the docids cached for the keys and if they are truncated, or None."""
+        value = super().get(keys)
+        if value is None:
+            return None
+        packed, truncated = value
+        return array.array(self.DOCIDS, packed), truncated
+
+    def put(self, keys, docids, truncated=False):
+        """Cache the docids found for the keys, evicting the least recently used ones."""
+        super().put(keys, (array.array(self.DOCIDS, docids).tobytes(), truncated))
+
+
+def prefix_end(prefix):
+    """Return the first string after all the ones that start with the prefix.
+
+    None is returned if there is no such string, as the prefix is only made of the last
+    unicode char.
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # the surrogates are not valid chars to store
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+
 def to_filename(title):
     """Compute the filename from the title."""
     tt = title.replace(" ", "_")
@@ -234,68 +775,331 @@ def to_filename(title):
     return expected
 
 
+@lru_cache(1000)
+def _get_word_quants_page(db, pageid):
+    """Return the array of word_quants in word of a page's titles."""
+    cur = db.execute("SELECT word_quants FROM docs where pageid = ?", (pageid,))
+    row = cur.fetchone()
+    decomp_data = array.array("B")
+    if row:
+        decomp_data.frombytes(row[0])
+    return decomp_data
+
+
 class Search:
     """Fetch and order some search."""
-    def __init__(self, db, keys):
+
+    # the similitude of a phrase exactly equal to the keys
+    EXACT_MATCH_BONUS = 1000
+
+    # quantity of results whose phrases are rebuilt together
+    PHRASES_WINDOW = 256
+
+    def __init__(self, db, keys, use_ngrams=False, use_docfreq=False, use_tokenids=False,
+                 page_size=PAGE_SIZE, word_quants=None, deadline=None, max_scored=None):
         self.db = db
-        self.docs = defaultdict(dict)
-        self.keys = keys
-        # create a set of result w/all keys
-        results = self._get_docs(keys[0])
-        for key in keys[1:]:
-            results &= self._get_docs(key)
+        # the time.monotonic() when the search is given up, and the max quantity of docs
+        # scored; once exceeded only the best results found so far are returned, and the
+        # search is truncated
+        self.deadline = deadline
+        self.max_scored = max_scored
+        self.truncated = False
+        self.page_size = page_size
+        # the word_quants of all the docs, if they are already loaded
+        self.word_quants = word_quants
+        self.use_ngrams = use_ngrams
+        # older indexes don't store the documents frequency, the docsets size is used instead
+        self.docfreq_column = "docfreq" if use_docfreq else "length(docsets)"
+        # and the n-grams of older indexes point to the rowid of the tokens
+        self.tokenid_column = "tokenid" if use_tokenids else "rowid"
+        # a list, to compare it with the phrases
+        self.keys = list(keys)
+        self._phrases = {}
+
+        # the (word, encoded docset, documents frequency) found for each key; if some key
+        # is not found at all there are no results, and the rest is not worth fetching
+        found = []
+        for key in keys:
+            found.append(self._fetch(key))
+            if not found[-1]:
+                found = [[]]
+                break
 
-        # computes the similitude of phrase
-        self.ordered = []
-        for docid in results:
-            word_quant = self._get_doc_word_quant(docid)
-            phrase = [""] * word_quant
-            for pos, word in self.docs[docid].items():
-                phrase[pos] = word
-            similitude = self.iterative_levenshtein(phrase)
+        # start from the rarest key, and then probe the words of the other keys only for
+        # the docs that survived so far, discarding the words without hits; once there
+        # are no results the docsets of the remaining keys are not even decoded
+        plan = sorted(range(len(found)), key=lambda i: sum(row[2] for row in found[i]))
+        key_matches = [[] for _ in found]
+        results = None
+        for i in plan:
+            if results is None:
+                results = set()
+                for word, encoded, _ in self._until_deadline(found[i]):
+                    key_matches[i].append((word, encoded))
+                    results.update(DocSet.decode_docids(encoded))
+            else:
+                # the docsets much bigger than the results are probed jumping over them
+                candidates = None
+                min_probe_size = len(results) * SKIP_INTERVAL
+                found_docids = set()
+                for word, encoded, docfreq in self._until_deadline(found[i]):
+                    if docfreq > min_probe_size and DocSet.has_skips(encoded):
+                        if candidates is None:
+                            candidates = sorted(results)
+                        hits = DocSet.probe(encoded, candidates)
+                    else:
+                        hits = results.intersection(DocSet.decode_docids(encoded))
+                    if hits:
+                        key_matches[i].append((word, encoded))
+                        found_docids.update(hits)
+                results = found_docids
+            if not results:
+                break
+        # without keys nothing is found
+        self.results = sorted(results or ())
+
+        # the (word, encoded docset) found for all the keys, in the keys order; the
+        # docsets are kept encoded (way more compact) and the phrases are only rebuilt
+        # when ranking
+        self.matches = [match for matches in key_matches for match in matches]
+
+        # a heap with a cursor over the docids of every match, as the phrases are rebuilt
+        # in docid order: (docid, match index, index of its position, offset of the next
+        # docid); small docsets are decoded step by step, while the big ones are decoded
+        # at once when its cursor is first used (the offset is None) to gallop over them
+        self._cursors = []
+        self._decoded = {}
+        if self.results:
+            for idx, (word, encoded) in enumerate(self.matches):
+                if len(encoded) > 1:
+                    if encoded[0] == DocSet.SEPARATOR:
+                        positions_start, _, docids_start, _, _ = DocSet._layout(encoded)
+                    else:
+                        positions_start = 0
+                        docids_start = encoded.index(DocSet.SEPARATOR) + 1
+                    docid, offset = DocSet.decode_varint(encoded, docids_start)
+                    if len(encoded) >= DECODE_IN_C_MIN_SIZE:
+                        offset = None
+                    self._cursors.append((docid, idx, positions_start, offset))
+            heapq.heapify(self._cursors)
+
+    def _expired(self):
+        """Return if the deadline of the search has passed."""
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def _until_deadline(self, items):
+        """Yield the items until the deadline passes, truncating the search."""
+        for idx, item in enumerate(items):
+            if idx % DEADLINE_CHECK_INTERVAL == 0 and self._expired():
+                self.truncated = True
+                return
+            yield item
+
+    def _execute(self, sql, parameters=()):
+        """Run the query and return all its rows.
+
+        If the deadline passes meanwhile the query is interrupted, the search is truncated,
+        and only the rows got so far are returned.
+        """
+        if self.deadline is None:
+            return self.db.execute(sql, parameters).fetchall()
+
+        rows = []
+        with self.db.connection() as con:
+            con.set_progress_handler(self._expired, PROGRESS_STEPS)
+            try:
+                for row in con.execute(sql, parameters):
+                    rows.append(row)
+            except sqlite3.OperationalError:
+                if not self._expired():
+                    raise
+                self.truncated = True
+            finally:
+                con.set_progress_handler(None, PROGRESS_STEPS)
+        return rows
 
-            # first docid are a LOT more important
-            order_factor = int(40000 * math.pow(docid + 1, -.5))
+    @staticmethod
+    def _order_factor(docid):
+        """Return the score part given by the docid: first docids are a LOT more important."""
+        return int(40000 * math.pow(docid + 1, -.5))
 
-            self.ordered.append((order_factor - similitude, docid))
+    def _build_phrases(self, docids):
+        """Rebuild the matched words, by position, of the given documents.
 
-        self.ordered.sort(reverse=True)
+        The documents must be requested in order, as the cursors only move forward. For
+        the same docid the matches are visited in order, so the last one sets the word.
+        """
+        phrases = {docid: {} for docid in docids}
+        last_docid = docids[-1]
+        cursors = self._cursors
+        while cursors and cursors[0][0] <= last_docid:
+            docid, idx, i, offset = cursors[0]
+            word, encoded = self.matches[idx]
+            phrase = phrases.get(docid)
+            if phrase is not None:
+                phrase[encoded[i]] = word
+
+            if offset is not None:
+                if offset < len(encoded):
+                    delta, offset = DocSet.decode_varint(encoded, offset)
+                    heapq.heapreplace(cursors, (docid + delta, idx, i + 1, offset))
+                else:
+                    heapq.heappop(cursors)
+                continue
+
+            match_docids = self._decoded.get(idx)
+            if match_docids is None:
+                # padded with the header size, to share the index with the positions
+                positions_start = DocSet._layout(encoded)[0]
+                match_docids = array.array('L', [0] * positions_start)
+                match_docids.extend(DocSet.decode_arrays(encoded)[0])
+                self._decoded[idx] = match_docids
+            if phrase is not None:
+                i += 1
+            else:
+                # jump to the next docid of this window, or past it
+                following = bisect.bisect_right(docids, docid)
+                if following < len(docids):
+                    i = bisect.bisect_left(match_docids, docids[following], i)
+                else:
+                    i = bisect.bisect_right(match_docids, last_docid, i)
+            if i < len(match_docids):
+                heapq.heapreplace(cursors, (match_docids[i], idx, i, None))
+            else:
+                heapq.heappop(cursors)
+                del self._decoded[idx]
+        self._phrases.update(phrases)
+
+    def _score(self, docid):
+        """Compute the score of a document, using the similitude of its phrase with the keys."""
+        if docid not in self._phrases:
+            # rebuild the phrases of this result and the following ones
+            idx = bisect.bisect_left(self.results, docid)
+            self._build_phrases(self.results[idx:idx + self.PHRASES_WINDOW])
+
+        word_quant = self._get_doc_word_quant(docid)
+        phrase = [""] * word_quant
+        for pos, word in self._phrases.pop(docid).items():
+            phrase[pos] = word
+        similitude = self.iterative_levenshtein(phrase)
+        return self._order_factor(docid) - similitude
+
+    def ordered(self):
+        """Yield the (score, docid) of the results, from the best to the worst.
+
+        Docids are assigned in descending score order, so the order factor decreases with
+        the docid, and the similitude only adds to it (EXACT_MATCH_BONUS) when the phrase
+        has the same quantity of words than the keys: the results are scored in docid
+        order, keeping the pending ones in a heap, and the best of them is yielded as soon
+        as no document still unscored can beat it. So the consumer that stops after the
+        first K results saves the scoring of the rest.
+
+        If the deadline passes or too many docs are scored, the search is truncated: the
+        rest of the results are not scored, and the already scored ones are yielded. At
+        least the first DEADLINE_CHECK_INTERVAL docs, the best ones, are always scored.
+        """
+        results = self.results
+        keys_quant = len(self.keys)
+        # index of the next result that could be an exact match
+        next_exact = 0
+        pending = []  # heap of (-score, -docid), so the best result is on top
+        for idx, docid in enumerate(results):
+            if idx == self.max_scored or (
+                    idx and idx % DEADLINE_CHECK_INTERVAL == 0 and self._expired()):
+                self.truncated = True
+                break
 
-    @lru_cache(1000)
-    def _get_page(self, pageid):
-        """Return the array of word_quants in word of a page's titles."""
-        cur = self.db.execute("SELECT word_quants FROM docs where pageid = ?", (pageid,))
-        row = cur.fetchone()
-        decomp_data = array.array("B")
-        if row:
-            decomp_data.frombytes(row[0])
-        return decomp_data
+            next_exact = max(next_exact, idx)
+            while next_exact < len(results):
+                if self._get_doc_word_quant(results[next_exact]) == keys_quant:
+                    break
+                next_exact += 1
+
+            # the best score that any of the remaining results could get
+            max_score = self._order_factor(docid)
+            if next_exact < len(results):
+                max_score = max(max_score, self._order_factor(
+                    results[next_exact]) + self.EXACT_MATCH_BONUS)
+
+            # on ties the greater docid goes first, so this docid could beat an equal score
+            while pending and -pending[0][0] > max_score:
+                neg_score, neg_docid = heapq.heappop(pending)
+                yield -neg_score, -neg_docid
+            heapq.heappush(pending, (-self._score(docid), -docid))
+
+        while pending:
+            neg_score, neg_docid = heapq.heappop(pending)
+            yield -neg_score, -neg_docid
 
     def _get_doc_word_quant(self, docid):
         """Return one stored document item."""
-        page_id, rel_position = divmod(docid, PAGE_SIZE)
-        word_quants = self._get_page(page_id)
+        if self.word_quants is not None:
+            return self.word_quants[docid]
+        page_id, rel_position = divmod(docid, self.page_size)
+        word_quants = _get_word_quants_page(self.db, page_id)
         if not word_quants:
             raise ValueError("Inconsistency on data, docid non exists")
         return word_quants[rel_position]
 
-    def _get_docs(self, key):
-        """Store the words asoc w/ the docs & return a found docs's set."""
-        found = set()
-        for word, docset in self._fetch(key):
-            for docid, positions in docset.items():
-                for pos in positions:
-                    self.docs[docid][pos] = word
-                found.add(docid)
-        return found
+    def has_matches(self, key):
+        """Return if some word contains the key, without decoding the docsets."""
+        return bool(self._fetch(key))
 
     def _fetch(self, key):
-        """Return all the values of a partial key search."""
-        sql = "select word, docsets as 'ds [docset]' from tokens"
-        sql += " where word like '%{}%'".format(key)
-        cur = self.db.execute(sql)
-        for row in cur.fetchall():
-            yield row[0], row[1]
+        """Return the (word, encoded docset, documents frequency) of a partial key search.
+
+        The rows are returned in the same order of a full scan of the tokens table.
+        """
+        # LIKE wildcards can not be resolved through the n-grams
+        if self.use_ngrams and '%' not in key and '_' not in key:
+            return self._fetch_ngrams(key)
+
+        sql = "select word, docsets, {} from tokens where word like ?".format(self.docfreq_column)
+        return self._execute(sql, ('%{}%'.format(key),))
+
+    def _get_candidate_tokens(self, key):
+        """Return the ids of the tokens that may contain the key, using the n-grams table."""
+        if len(key) <= NGRAM_SIZE:
+            # the key is inside some n-gram of every word that contains it
+            rows = self._execute("SELECT tokenids FROM ngrams WHERE instr(gram, ?) > 0", (key,))
+            tokenids = set()
+            for row in rows:
+                tokenids.update(DocSet.delta_decode(row[0]))
+            return tokenids
+
+        # the word must contain every n-gram of the key, intersect starting from the rarest
+        grams = list(get_ngrams(key))
+        sql = "SELECT tokenids FROM ngrams WHERE gram IN ({}) ORDER BY length(tokenids)".format(
+            ",".join("?" * len(grams)))
+        rows = self._execute(sql, grams)
+        if len(rows) < len(grams):
+            return []
+        tokenids = None
+        for (encoded,) in rows:
+            gram_tokenids = DocSet.delta_decode(encoded)
+            if tokenids is None:
+                tokenids = gram_tokenids
+            else:
+                tokenids = intersect_sorted(tokenids, gram_tokenids)
+            if not tokenids:
+                break
+        return tokenids
+
+    def _fetch_ngrams(self, key):
+        """Return the (word, encoded docset, documents frequency) of a partial key search.
+
+        The n-grams table is used, and the rows are returned in the same order of a full
+        scan of the tokens table.
+        """
+        tokenids = sorted(self._get_candidate_tokens(key))
+        rows = []
+        for i in range(0, len(tokenids), SQL_VARS_LIMIT):
+            chunk = tokenids[i:i + SQL_VARS_LIMIT]
+            sql = "SELECT word, docsets, {0} FROM tokens WHERE {1} IN ({2}) ORDER BY {1}".format(
+                self.docfreq_column, self.tokenid_column, ",".join("?" * len(chunk)))
+            # candidates have all the n-grams, but not necessarily the whole key
+            rows.extend(row for row in self._execute(sql, chunk) if key in row[0])
+        return rows
 
     def iterative_levenshtein(self, phrase):
         """Compute the Levenshtein distance between the lists keys and phrase.
@@ -307,7 +1111,7 @@ class Search:
 
         # If there are exact match, put on the top
         if self.keys == phrase:
-            return -1000
+            return -self.EXACT_MATCH_BONUS
 
         keys = self.keys
         rows = len(keys) + 1
@@ -355,16 +1159,115 @@ class Search:
 class Index:
     """Handle the index."""
 
-    def __init__(self, directory):
+    def __init__(self, directory, mmap=False, preload=False, cache_size=QUERY_CACHE_SIZE,
+                 search_timeout=None, search_max_scored=None):
+        """Open the index in the directory.
+
+        By default everything is read from disk when needed, using little memory. For
+        server deployments, with mmap the database is mapped in memory and all of it is
+        read at startup, so the searches never touch the disk; with preload the docs are
+        also decompressed and kept in memory. Preload implies mmap, so the tokens and the
+        other tables used by the searches are in memory too. The docids found by the
+        searches are cached using up to cache_size bytes.
+
+        Each search can be limited to some seconds and to a quantity of scored docs, and
+        it's truncated when any of them is exceeded.
+        """
         self._directory = directory
         keyfilename = os.path.join(directory, "index.sqlite")
-        self.db = open_connection(keyfilename)
-        self.db.executescript('''
+        script = '''
             PRAGMA query_only = True;
             PRAGMA journal_mode = MEMORY;
             PRAGMA temp_store = MEMORY;
             PRAGMA synchronous = OFF;
-            ''')
+            '''
+        if mmap or preload:
+            script += "PRAGMA mmap_size = {};".format(os.path.getsize(keyfilename))
+        # the request threads of the server query the index concurrently
+        self.db = ConnectionPool(keyfilename, script)
+        # indexes created by older versions have no n-grams table nor documents frequency
+        cur = self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'ngrams'")
+        self.use_ngrams = cur.fetchone() is not None
+        cur = self.db.execute("PRAGMA table_info(tokens)")
+        tokens_columns = [row[1] for row in cur.fetchall()]
+        self.use_docfreq = 'docfreq' in tokens_columns
+        # nor have their tokens clustered by word, with a tokenid for the n-grams
+        self.use_tokenids = 'tokenid' in tokens_columns
+        # nor the deletes of the words to correct misspelled keys
+        cur = self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'deletes'")
+        self.use_deletes = cur.fetchone() is not None
+        # nor the original articles, to choose a random one by score
+        cur = self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'articles'")
+        self.use_articles = cur.fetchone() is not None
+        # and their docs pages are pickled lists of IndexEntry, instead of compact records
+        cur = self.db.execute("PRAGMA table_info(docs)")
+        self.use_records = 'records' in (row[1] for row in cur.fetchall())
+
+        # the parameters and figures of the index build; older indexes have no metadata,
+        # but they were always built with the same parameters
+        self.meta = {'codec': DEFAULT_CODEC, 'page_size': str(PAGE_SIZE), 'format_version': '0'}
+        cur = self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'meta'")
+        if cur.fetchone() is not None:
+            self.meta.update(self.db.execute("SELECT key, value FROM meta").fetchall())
+        if int(self.meta['format_version']) > FORMAT_VERSION:
+            raise ValueError("The index format version {} is not supported (up to {})".format(
+                self.meta['format_version'], FORMAT_VERSION))
+        if self.meta['codec'] not in CODECS:
+            raise ValueError("Unknown codec of the index: {!r}".format(self.meta['codec']))
+        self._decompress = CODECS[self.meta['codec']][1]
+        self.page_size = int(self.meta['page_size'])
+
+        self.cache = QueryCache(cache_size)
+        self.search_timeout = search_timeout
+        self.search_max_scored = search_max_scored
+        self._truncated_searches = 0
+        self._stats_lock = threading.Lock()
+
+        # the decompressed pages and the word_quants of all the docs, when preloaded
+        self._pages = None
+        self._word_quants = None
+        if mmap or preload:
+            self._warm_up(preload)
+
+    def _warm_up(self, preload):
+        """Read all the database, and maybe load the docs, logging the progress."""
+        docs_column = "records" if self.use_records else "data"
+        tables = [("tokens", "docsets")]
+        if self.use_ngrams:
+            tables.append(("ngrams", "tokenids"))
+        if self.use_deletes:
+            tables.append(("deletes", "tokenids"))
+        if not preload:
+            tables.append(("docs", "word_quants, " + docs_column))
+        with self.db.connection() as con:
+            for table, column in tables:
+                logger.info("Warming up the index: reading %s %s", table, column)
+                # the values are read one by one, just to get them from the disk
+                for _ in con.execute("SELECT {} FROM {}".format(column, table)):
+                    pass
+        if self.use_articles:
+            # the original articles to choose the random ones are kept decoded
+            self._articles()
+        if not preload:
+            return
+
+        cur = self.db.execute(
+            "SELECT pageid, word_quants, {} FROM docs ORDER BY pageid".format(docs_column))
+        rows = cur.fetchall()
+        pages = {}
+        word_quants = array.array("B")
+        for i, (pageid, page_word_quants, data) in enumerate(rows, 1):
+            pages[pageid] = self._decompress_page(data)
+            word_quants.frombytes(page_word_quants)
+            if i % max(1, len(rows) // 10) == 0:
+                logger.info("Warming up the index: loaded %d%% of the docs", i * 100 // len(rows))
+        self._pages = pages
+        self._word_quants = word_quants
+        logger.info("Warming up the index: done")
 
     def keys(self):
         """Return an iterator over the stored keys."""
@@ -379,27 +1282,58 @@ class Index:
         for row in cur.fetchall():
             yield row[0], row[1]
 
+    def _decompress_page(self, data):
+        """Decompress a page of docs, getting the records or the pickled entries."""
+        if self.use_records:
+            return self._decompress(data)
+        return decompress_data(data)
+
+    def _page_entries(self, page):
+        """Return all the entries of a decompressed page of docs."""
+        if self.use_records:
+            return DocsPage.decode_all(page)
+        return page
+
     def values(self):
         """Return an iterator over the stored values."""
-        cur = self.db.execute("SELECT pageid, data FROM docs ORDER BY pageid")
+        column = "records" if self.use_records else "data"
+        cur = self.db.execute("SELECT pageid, {} FROM docs ORDER BY pageid".format(column))
         for row in cur.fetchall():
-            decomp_data = decompress_data(row[1])
-            for doc in decomp_data:
+            for doc in self._page_entries(self._decompress_page(row[1])):
                 yield doc
 
     @lru_cache(1)
     def __len__(self):
-        """Compute the total number of docs in compressed pages."""
-        sql = "Select pageid, data from docs order by pageid desc limit 1"
-        cur = self.db.execute(sql)
-        row = cur.fetchone()
-        decomp_data = decompress_data(row[1])
-        return row[0] * PAGE_SIZE + len(decomp_data)
+        """Return the total number of docs, computing it for indexes without metadata."""
+        if 'doc_count' in self.meta:
+            return int(self.meta['doc_count'])
+        cur = self.db.execute("SELECT max(pageid) FROM docs")
+        last_pageid = cur.fetchone()[0]
+        page = self._get_page(last_pageid)
+        if self.use_records:
+            return last_pageid * self.page_size + DocsPage.length(page)
+        return last_pageid * self.page_size + len(page)
+
+    @lru_cache(1)
+    def _articles(self):
+        """Return the docids of the original articles, and their cumulative weights."""
+        docids, weights = self.db.execute("SELECT docids, weights FROM articles").fetchone()
+        return (array.array('I', DocSet.delta_decode(docids)),
+                array.array('Q', DocSet.delta_decode(weights)))
 
     def random(self):
-        """Return a random value."""
-        docid = random.randint(0, len(self) - 1)
-        return self.get_doc(docid)
+        """Return a random value.
+
+        It's an original article, chosen with a probability proportional to its score; in
+        older indexes it's any doc, even a redirect.
+        """
+        if not self.use_articles:
+            docid = random.randint(0, len(self) - 1)
+            return self.get_doc(docid)
+
+        docids, weights = self._articles()
+        position = bisect.bisect_right(weights, random.randrange(weights[-1]))
+        return self.get_doc(docids[position])
 
     def __contains__(self, key):
         """Return if the key is in the index or not."""
@@ -408,23 +1342,33 @@ class Index:
             return True
         return False
 
-    @lru_cache(1000)
     def _get_page(self, pageid):
-        """Get a page of doc entry data."""
-        cur = self.db.execute("SELECT data FROM docs where pageid = ?", (pageid,))
+        """Get a decompressed page of doc entry data."""
+        if self._pages is not None:
+            return self._pages.get(pageid)
+        return self._load_page(pageid)
+
+    @lru_cache(1000)
+    def _load_page(self, pageid):
+        """Load a page of doc entry data, and decompress it."""
+        column = "records" if self.use_records else "data"
+        cur = self.db.execute("SELECT {} FROM docs where pageid = ?".format(column), (pageid,))
         row = cur.fetchone()
         if row:
-            decomp_data = decompress_data(row[0])
-            return decomp_data
+            return self._decompress_page(row[0])
         return None
 
     def _get_raw_doc(self, docid):
         """Return one stored document item, no redirect compute."""
-        page_id, rel_position = divmod(docid, PAGE_SIZE)
+        page_id, rel_position = divmod(docid, self.page_size)
         data = self._get_page(page_id)
         if not data:
             raise IndexError("Non existing docid")
-        idx_entry = data[rel_position]
+        if self.use_records:
+            # only the requested record is decoded
+            idx_entry = DocsPage.decode(data, rel_position)
+        else:
+            idx_entry = data[rel_position]
         if idx_entry.rtype == IndexEntry.TYPE_ORIG_SIMPLE_LINK:
             idx_entry.link = to_filename(idx_entry.title)
         return idx_entry
@@ -445,35 +1389,227 @@ class Index:
         else:
             return idx_entry
 
-    def search(self, keys):
-        """Return all the values that are found for those keys.
+    def search(self, keys, offset=0, limit=None):
+        """Return the values that are found for those keys, as SearchResults.
 
-        The AND boolean operation is applied to the keys.
+        The AND boolean operation is applied to the keys. If nothing is found, the keys
+        that are not in any word are replaced by their closest word and searched again.
+        All the results are ranked, and their docids are cached by the normalized keys,
+        but only the page of limit values from offset is got. The ranking of a truncated
+        search is also cached, so its next pages are got from the same ranking.
+        """
+        keys = tuple(word for key in keys for word in normalize_words(key).split())
+        if not keys:
+            return SearchResults()
+        cached = self.cache.get(keys)
+        if cached is None:
+            docids, truncated = self._rank(keys)
+        else:
+            docids, truncated = cached
+        end = None if limit is None else offset + limit
+        return SearchResults(map(self.get_doc, docids[offset:end]), total=len(docids),
+                             truncated=truncated)
+
+    def _rank(self, keys):
+        """Return the docids found for the keys from the best, and if they are truncated."""
+        deadline = None
+        if self.search_timeout is not None:
+            deadline = time.monotonic() + self.search_timeout
+        results = SearchResults()
+        docids = list(self._search_corrected(keys, deadline, results))
+        if results.truncated:
+            logger.debug("Search of %s truncated with %d results", keys, len(docids))
+            with self._stats_lock:
+                self._truncated_searches += 1
+        # a truncated search without results is not kept, as it may find something when
+        # the server is less busy
+        if docids or not results.truncated:
+            self.cache.put(keys, docids, results.truncated)
+        return docids, results.truncated
+
+    def _search_corrected(self, keys, deadline, results):
+        """Return the docids found for the keys, correcting them if needed."""
+        found = False
+        for result in self._search_keys(keys, deadline, results):
+            found = True
+            yield result
+        if found or results.truncated:
+            return
+
+        # only the keys without any word are corrected, so their words are just fetched
+        fetcher = Search(self.db, (), use_ngrams=self.use_ngrams, use_docfreq=self.use_docfreq,
+                         use_tokenids=self.use_tokenids, deadline=deadline)
+        corrected = []
+        for key in keys:
+            if not fetcher.has_matches(key):
+                if fetcher.truncated or (deadline is not None and time.monotonic() > deadline):
+                    # the key may not be found just because the time is over
+                    results.truncated = True
+                    return
+                words = self.fuzzy_words(key)
+                if words:
+                    key = words[0]
+            corrected.append(key)
+        corrected = tuple(corrected)
+        if corrected != keys:
+            logger.debug("Searching %s corrected as %s", keys, corrected)
+            for result in self._search_keys(corrected, deadline, results):
+                yield result
+
+    def search_stats(self):
+        """Return the counters of the searches cache, and of the truncated searches."""
+        stats = self.cache.stats()
+        with self._stats_lock:
+            stats['truncated'] = self._truncated_searches
+        return stats
+
+    def fuzzy_words(self, key):
+        """Return the words that may be the misspelled key, the closest and commonest first.
+
+        The key with up to two chars deleted is looked up in the deletes of the words, so
+        the vocabulary is never scanned. As the words are stored with only one char deleted,
+        the ones at two edits are found if they need at most one deletion to match the key.
+        """
+        if not self.use_deletes or len(key) < FUZZY_MIN_WORD:
+            return []
+        max_distance = 1 if len(key) < FUZZY_LONG_WORD else 2
+        variants = get_deletes(key)
+        if max_distance > 1:
+            variants.update(*map(get_deletes, variants))
+        hashes = sorted({hash_variant(variant) for variant in variants | {key}})
+
+        tokenids = set()
+        for i in range(0, len(hashes), SQL_VARS_LIMIT):
+            chunk = hashes[i:i + SQL_VARS_LIMIT]
+            sql = "SELECT tokenids FROM deletes WHERE hash IN ({})".format(
+                ",".join("?" * len(chunk)))
+            for (encoded,) in self.db.execute(sql, chunk).fetchall():
+                tokenids.update(DocSet.delta_decode(encoded))
+
+        tokenids = sorted(tokenids)
+        candidates = []
+        for i in range(0, len(tokenids), SQL_VARS_LIMIT):
+            chunk = tokenids[i:i + SQL_VARS_LIMIT]
+            sql = "SELECT word, docfreq FROM tokens WHERE tokenid IN ({})".format(
+                ",".join("?" * len(chunk)))
+            for word, docfreq in self.db.execute(sql, chunk).fetchall():
+                if abs(len(word) - len(key)) > max_distance:
+                    continue
+                distance = edit_distance(key, word)
+                if 0 < distance <= max_distance:
+                    candidates.append((distance, -docfreq, word))
+        return [word for _, _, word in sorted(candidates)]
+
+    def _origin_docid(self, docid):
+        """Return the docid of the original article of a doc, without getting all of it."""
+        page_id, rel_position = divmod(docid, self.page_size)
+        data = self._get_page(page_id)
+        if not data:
+            raise IndexError("Non existing docid")
+        if self.use_records:
+            rtype, orig_docid = DocsPage.decode_origin(data, rel_position)
+        else:
+            rtype, orig_docid = data[rel_position].rtype, data[rel_position].orig_docid
+        return orig_docid if rtype == IndexEntry.TYPE_REDIRECT else docid
+
+    def _search_keys(self, keys, deadline=None, results=None):
+        """Return the docids found for the normalized keys, from the best.
+
+        The results are flagged as truncated if the search exceeds its budget.
+        """
+        origins_yielded = set()
+        docset = Search(self.db, keys, use_ngrams=self.use_ngrams, use_docfreq=self.use_docfreq,
+                        use_tokenids=self.use_tokenids, page_size=self.page_size,
+                        word_quants=self._word_quants, deadline=deadline,
+                        max_scored=self.search_max_scored)
+        for score, ndoc in docset.ordered():
+            # Do not return more than one index result to the same file (the redirects
+            # have the link of their original article)
+            origin = self._origin_docid(ndoc)
+            if origin not in origins_yielded:
+                origins_yielded.add(origin)
+                yield ndoc
+            if len(origins_yielded) >= MAX_RESULTS:
+                break
+        if docset.truncated and results is not None:
+            results.truncated = True
+
+    def search_prefix(self, keys, quantity):
+        """Return the best scored values with a word that starts with the last key.
+
+        The previous keys must be complete words of the values. The words with the prefix
+        are got scanning a range of the tokens, and as the docids are assigned in score
+        order only the first docids of each one are decoded.
         """
         keys = list(map(normalize_words, keys))
-        files_yielded = set()
-        docset = Search(self.db, keys)
-        for score, ndoc in docset.ordered:
-            doc_data = self.get_doc(ndoc)
-            # Do not return more than one index result to the same file.
-            if doc_data.link not in files_yielded:
-                files_yielded.add(doc_data.link)
-                yield doc_data
-            if len(files_yielded) >= MAX_RESULTS:
+        if not keys or not keys[-1]:
+            return []
+        prefix = keys[-1]
+        allowed = None
+        for word in keys[:-1]:
+            row = self.db.execute("SELECT docsets FROM tokens WHERE word = ?", (word,)).fetchone()
+            if row is None:
+                return []
+            docids = set(DocSet.decode_docids(row[0]))
+            allowed = docids if allowed is None else allowed & docids
+
+        # the first string after all the ones that start with the prefix, if any
+        end = prefix_end(prefix)
+        if end is None:
+            rows = self.db.execute(
+                "SELECT docsets FROM tokens WHERE word >= ?", (prefix,)).fetchall()
+        else:
+            rows = self.db.execute(
+                "SELECT docsets FROM tokens WHERE word >= ? AND word < ?",
+                (prefix, end)).fetchall()
+
+        # the redirects of an article have the docids following it, so more docids are
+        # taken until there are enough different articles, or no more docs
+        wanted = quantity * 2
+        while True:
+            best = []
+            for (encoded,) in rows:
+                # the words whose first doc is not better than the ones found are skipped
+                below = best[-1] if len(best) == wanted else None
+                docids = DocSet.first_docids(encoded, wanted, below)
+                if docids and allowed is not None:
+                    docids = sorted(allowed.intersection(DocSet.decode_docids(encoded)))
+                if docids:
+                    best = sorted(set(best).union(docids[:wanted]))[:wanted]
+
+            found = collections.OrderedDict()
+            for docid in best:
+                found.setdefault(self._origin_docid(docid), docid)
+                if len(found) >= quantity:
+                    break
+            if len(found) >= quantity or len(best) < wanted:
                 break
+            wanted *= 2
+        return [self.get_doc(docid) for docid in found.values()]
 
     @classmethod
-    def create(cls, directory, source):
+    def create(cls, directory, source, codec=DEFAULT_CODEC, page_size=PAGE_SIZE, workers=1):
         """Create the index in the directory.
 
         The source must give path, page_score, title and
         a list of extracted words from title in an ordered fashion
         It must return the quantity of pairs indexed.
+
+        The docs are stored in pages of page_size, compressed with the codec (one of
+        CODECS); both are recorded in the index metadata.
+
+        The memory used is bounded: the source is sorted, and the tokens are collected,
+        by runs that are spilled to temporary files and then merged.
+
+        With more than one worker, the docs pages are compressed in that quantity of
+        processes, while they are inserted in order; the tables are the same than when
+        building in only one process.
         """
-        import pickletools
-        import time
         from progress.bar import Bar
 
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: {!r}".format(codec))
+
         class SQLmany:
             """Execute many INSERTs greatly improves the performance."""
             def __init__(self, name, sql, quantity):
@@ -481,13 +1617,14 @@ class Index:
                 self.name = name
                 self.count = 0
                 self.buffer = []
+                self.pending = collections.deque()
                 self.progress_bar = Bar(name, max=quantity, suffix='%(index)d/%(max)d\r')
 
             def append(self, data):
                 """Append one data set to persist on db."""
                 self.buffer.append(data)
                 self.count += 1
-                if self.count % PAGE_SIZE == 0:
+                if self.count % page_size == 0:
                     self.persist()
                     self.buffer = []
                 # self.count is the quantity of docs added
@@ -500,30 +1637,45 @@ class Index:
                 """Finish the process and show some data."""
                 if self.buffer:
                     self.persist()
+                while self.pending:
+                    self.write(self.pending.popleft().result())
+                database.commit()
                 self.progress_bar.finish()
                 dict_stats[self.name] = self.count
 
             def persist(self):
-                """Commit data to index."""
-                database.executemany(self.sql, self.buffer)
-                database.commit()
+                """Send data to index."""
+                self.write(self.buffer)
+
+            def submit(self, function, *args):
+                """Write the rows returned by the function, called by a worker if any.
+
+                Only a few batches are kept waiting, to be written in the same order."""
+                if executor is None:
+                    self.write(function(*args))
+                    return
+                self.pending.append(executor.submit(function, *args))
+                while len(self.pending) > workers * 2:
+                    self.write(self.pending.popleft().result())
+
+            def write(self, rows):
+                """Insert the rows in the database."""
+                database.executemany(self.sql, rows)
 
         class Compressed(SQLmany):
             """Creates the table of compressed documents information.
 
-            The groups is PAGE_SIZE word_quant, pickled and compressed."""
+            The groups is page_size word_quant, encoded in a page and compressed."""
             def persist(self):
-                """Compress and commit data to index."""
+                """Compress and send data to index."""
                 docs_data = []
                 word_quants = array.array("B")
                 for word_quant, data in self.buffer:
                     word_quants.append(word_quant)
                     docs_data.append(data)
-                pickdata = pickletools.optimize(pickle.dumps(docs_data))
-                comp_data = best_compressor.compress(pickdata)
-                page_id = (self.count - 1) // PAGE_SIZE
-                database.execute(self.sql, (page_id, word_quants.tobytes(), comp_data))
-                database.commit()
+                page_id = (self.count - 1) // page_size
+                self.submit(_compress_docs_page, codec, page_id, word_quants.tobytes(),
+                            DocsPage.encode(docs_data))
 
         def create_database():
             """Creates de basic structure of new database."""
@@ -531,21 +1683,44 @@ class Index:
                 PRAGMA journal_mode = OFF;
                 PRAGMA synchronous = OFF;
                 CREATE TABLE tokens
-                    (word TEXT,
-                    docsets BLOB);
+                    (word TEXT PRIMARY KEY,
+                    tokenid INTEGER,
+                    docsets BLOB,
+                    docfreq INTEGER) WITHOUT ROWID;
                 CREATE TABLE docs
                     (pageid INTEGER PRIMARY KEY,
                     word_quants BLOB,
-                    data BLOB);
+                    records BLOB);
+                CREATE TABLE ngrams
+                    (gram TEXT,
+                    tokenids BLOB);
+                CREATE TABLE deletes
+                    (hash INTEGER PRIMARY KEY,
+                    tokenids BLOB);
+                CREATE TABLE articles
+                    (docids BLOB,
+                    weights BLOB);
+                CREATE TABLE meta
+                    (key TEXT PRIMARY KEY,
+                    value TEXT);
                 """
 
             database.executescript(script)
 
-        def add_docs_keys(source):
-            """Add docs and keys registers to db and its rel in memory."""
+        def spill_tokens(idx_dict):
+            """Write the collected tokens to a temporary file, sorted by word."""
+            run = ((word, list(idx_dict[word].items())) for word in sorted(idx_dict))
+            tokens_runs.append((len(idx_dict), _write_run(run, directory)))
+            idx_dict.clear()
+
+        def add_docs_keys(source, quantity):
+            """Add docs and keys registers to db and its rel in memory.
+
+            When too many words positions are collected, they are spilled to a run."""
             idx_dict = defaultdict(DocSet)
-            sql = "INSERT INTO docs (pageid, word_quants, data) VALUES (?, ?, ?)"
-            docs_table = Compressed("Documents", sql, len(source))
+            positions = 0
+            sql = "INSERT INTO docs (pageid, word_quants, records) VALUES (?, ?, ?)"
+            docs_table = Compressed("Documents", sql, quantity)
 
             for title, link, score, description, orig_words, redir_words in source:
                 idx_entry = IndexEntry(
@@ -558,6 +1733,8 @@ class Index:
                     idx_entry.link = None
                     idx_entry.rtype = IndexEntry.TYPE_ORIG_SIMPLE_LINK
                 orig_docid = docs_table.append((len(orig_words), idx_entry))
+                articles_docids.append(orig_docid)
+                articles_weights.append(articles_weights[-1] + max(1, score))
                 for idx, word in enumerate(orig_words):
                     idx_dict[word].append(orig_docid, idx)
                 for word_set in redir_words:
@@ -571,39 +1748,169 @@ class Index:
                     redir_docid = docs_table.append((len(word_set), redir_entry))
                     for idx, word in enumerate(word_set):
                         idx_dict[word].append(redir_docid, idx)
+                    positions += len(word_set)
+                positions += len(orig_words)
+                if positions >= TOKENS_RUN_SIZE:
+                    spill_tokens(idx_dict)
+                    positions = 0
 
             docs_table.finish()
+            if tokens_runs and idx_dict:
+                spill_tokens(idx_dict)
             return idx_dict
 
+        def add_articles_to_db():
+            """Insert the docids of the original articles, and their cumulative weights.
+
+            Both are increasing, so they are delta encoded, the weights being their scores.
+            """
+            database.execute("INSERT INTO articles (docids, weights) VALUES (?, ?)", (
+                DocSet.delta_encode(articles_docids), DocSet.delta_encode(articles_weights[1:])))
+            database.commit()
+            dict_stats["Articles"] = len(articles_docids)
+
+        def merge_tokens_runs():
+            """Merge the runs by word, joining the docs of each word in docid order."""
+            runs = [_read_run(fh) for _, fh in tokens_runs]
+            merged = heapq.merge(*runs, key=operator.itemgetter(0))
+            for word, group in itertools.groupby(merged, key=operator.itemgetter(0)):
+                docs_list = DocSet()
+                # runs are merged in the order they were written, so docids keep ordered
+                for _, items in group:
+                    docs_list._docs_list.update(items)
+                yield word, docs_list
+
         def add_tokens_to_db(idx_dict):
             """Insert token words in the database."""
-            sql_ins = "insert into tokens (word, docsets) values (?, ?)"
-            token_store = SQLmany("Tokens", sql_ins, len(idx_dict))
-            for word, docs_list in idx_dict.items():
+            sql_ins = "insert into tokens (word, tokenid, docsets, docfreq) values (?, ?, ?, ?)"
+            if tokens_runs:
+                # the words repeated in several runs are counted more than once
+                quantity = sum(words for words, _ in tokens_runs)
+                tokens = merge_tokens_runs()
+            else:
+                quantity = len(idx_dict)
+                tokens = sorted(idx_dict.items())
+            token_store = SQLmany("Tokens", sql_ins, quantity)
+            # the tokens are inserted in the order they are clustered, as the rowids were
+            for tokenid, (word, docs_list) in enumerate(tokens, 1):
                 logger.debug("Word: %s %r" % (word, docs_list))
                 dict_stats["Indexed"] += len(docs_list)
-                token_store.append((word, docs_list))
+                token_store.append((word, tokenid, docs_list, len(docs_list)))
             token_store.finish()
 
+        def add_ngrams_to_db():
+            """Insert the n-grams of the stored tokens, pointing to the tokens' ids."""
+            idx_ngrams = defaultdict(list)
+            cur = database.execute("SELECT tokenid, word FROM tokens ORDER BY tokenid")
+            for tokenid, word in cur.fetchall():
+                for gram in get_ngrams(word):
+                    idx_ngrams[gram].append(tokenid)
+
+            sql_ins = "insert into ngrams (gram, tokenids) values (?, ?)"
+            ngrams_store = SQLmany("N-grams", sql_ins, len(idx_ngrams))
+            # sorted, as the grams of each word come in an arbitrary order
+            for gram, tokenids in sorted(idx_ngrams.items()):
+                ngrams_store.append((gram, DocSet.delta_encode(tokenids)))
+            ngrams_store.finish()
+
+        def add_deletes_to_db():
+            """Insert the words, and them with one char deleted, pointing to the tokens' ids.
+
+            They are sorted externally, as there are many of them."""
+            def get_variants():
+                cur = database.execute("SELECT tokenid, word FROM tokens ORDER BY tokenid")
+                for tokenid, word in cur:
+                    if len(word) >= FUZZY_MIN_WORD and not word.isdigit():
+                        for variant in get_deletes(word) | {word}:
+                            yield hash_variant(variant), tokenid
+
+            quantity, variants = external_sort(
+                get_variants(), directory, DELETES_RUN_SIZE, key=operator.itemgetter(0))
+            sql_ins = "insert into deletes (hash, tokenids) values (?, ?)"
+            # the quantity of variants with their words repeated
+            deletes_store = SQLmany("Deletes", sql_ins, quantity)
+            for variant_hash, group in itertools.groupby(variants, key=operator.itemgetter(0)):
+                # the variants with the same hash are mixed, and the tokenids kept sorted
+                tokenids = sorted({tokenid for _, tokenid in group})
+                deletes_store.append((variant_hash, DocSet.delta_encode(tokenids)))
+            deletes_store.finish()
+
+        def add_meta_to_db(timings):
+            """Insert the parameters and figures of the index build."""
+            meta = {
+                'format_version': FORMAT_VERSION,
+                'codec': codec,
+                'page_size': page_size,
+                'doc_count': dict_stats["Documents"],
+                'token_count': dict_stats["Tokens"],
+                'ngram_count': dict_stats["N-grams"],
+                'delete_count': dict_stats["Deletes"],
+                'article_count': dict_stats["Articles"],
+                'build_tokens_runs': len(tokens_runs),
+                'build_workers': workers,
+            }
+            if dict_stats["Peak RSS (MB)"]:
+                meta['build_peak_rss_mb'] = dict_stats["Peak RSS (MB)"]
+            for step, seconds in timings.items():
+                meta['build_time_' + step] = round(seconds, 3)
+            database.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                 ((key, str(value)) for key, value in meta.items()))
+            database.commit()
+
         def create_indexes():
             script = '''
-                create index idx_words on tokens (word);
+                create unique index idx_tokenids on tokens (tokenid);
+                create index idx_ngrams on ngrams (gram);
+                analyze;
                 vacuum;
+                pragma optimize;
                 '''
             database.executescript(script)
 
-        logger.info("Indexing")
+        logger.info("Indexing with %d workers", workers)
         initial_time = time.time()
         dict_stats = defaultdict(int)
         keyfilename = os.path.join(directory, "index.sqlite")
         database = open_connection(keyfilename)
         create_database()
-        ordered_source = sorted(source, reverse=True, key=operator.itemgetter(2))
-        if not ordered_source:
+        quantity, ordered_source = external_sort(
+            source, directory, SORT_RUN_SIZE, key=operator.itemgetter(2), reverse=True)
+        if not quantity:
             raise ValueError("No data to index")
-        idx_dict = add_docs_keys(ordered_source)
+        tokens_runs = []
+        # the docids of the original articles, and the cumulative sum of their scores
+        articles_docids = array.array('I')
+        articles_weights = array.array('Q', [0])
+        timings = {}
+        executor = None
+        if workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        try:
+            step_time = time.time()
+            idx_dict = add_docs_keys(ordered_source, quantity)
+            add_articles_to_db()
+            timings['docs'] = time.time() - step_time
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        step_time = time.time()
         add_tokens_to_db(idx_dict)
+        timings['tokens'] = time.time() - step_time
+        step_time = time.time()
+        add_ngrams_to_db()
+        timings['ngrams'] = time.time() - step_time
+        step_time = time.time()
+        add_deletes_to_db()
+        timings['deletes'] = time.time() - step_time
+        step_time = time.time()
         create_indexes()
+        timings['indexes'] = time.time() - step_time
+        timings['total'] = time.time() - initial_time
+        dict_stats["Tokens runs"] = len(tokens_runs)
+        dict_stats["Peak RSS (MB)"] = peak_rss()
+        for step, seconds in timings.items():
+            dict_stats["Time {} (s)".format(step)] = round(seconds, 1)
+        add_meta_to_db(timings)
         dict_stats["Total time"] = int(time.time() - initial_time)
         # Finally, show some statistics.
         for k, v in dict_stats.items():
@@ -217,6 +217,12 @@ def gen_run_config(lang_config):
     f.write('DIR_INDICE = "indice"\n')
     f.write('IMAGES_PER_BLOCK = %d\n' % config.IMAGES_PER_BLOCK)
     f.write('ARTICLES_PER_BLOCK = %d\n' % config.ARTICLES_PER_BLOCK)
+    f.write('ARTICLES_CACHE_SIZE = %d\n' % config.ARTICLES_CACHE_SIZE)
+    f.write('INDEX_MMAP = %s\n' % config.INDEX_MMAP)
+    f.write('INDEX_PRELOAD = %s\n' % config.INDEX_PRELOAD)
+    f.write('INDEX_QUERY_CACHE_SIZE = %d\n' % config.INDEX_QUERY_CACHE_SIZE)
+    f.write('INDEX_SEARCH_TIMEOUT = %r\n' % config.INDEX_SEARCH_TIMEOUT)
+    f.write('INDEX_SEARCH_MAX_SCORED = %r\n' % config.INDEX_SEARCH_MAX_SCORED)
     f.write('NAMESPACES_PREFIXES_DIR = os.path.join("assets", "dynamic")\n')
     f.close()
 
@@ -21,8 +21,10 @@ import logging
 import queue
 import os
 import socket
+import sys
 import threading
 import time
+from collections import OrderedDict
 from hashlib import md5
 
 import config
@@ -59,6 +61,66 @@ class WatchDog(threading.Thread):
         self.callback()
 
 
+class SizedLRUCache:
+    """Cache bounded by its size in bytes, evicting the least recently used entries.
+
+    It's shared by the server threads, counting the hits, misses and evictions. The size
+    of the entries is approximated from their key and value.
+    """
+    # approximate memory used by each entry besides its key and value (the dict slot,
+    # the linked list node and the objects headers)
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry_size(self, key, value):
+        """Return the approximate bytes of memory used by the entry."""
+        return self.ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value)
+
+    def get(self, key):
+        """Return the value cached for the key, or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Cache the value, evicting the least recently used ones if needed."""
+        entry_size = self._entry_size(key, value)
+        if entry_size > self.size:
+            return
+        with self._lock:
+            if key in self._entries:
+                # another thread got the same value meanwhile
+                return
+            self._entries[key] = value
+            self.used += entry_size
+            while self.used > self.size:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.used -= self._entry_size(old_key, old_value)
+                self.evictions += 1
+
+    def stats(self):
+        """Return the counters and the size of the cache."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.used}
+
+
 def coherent_hash(txt):
     """
     Create a hash from a bytestring.
@@ -16,9 +16,11 @@
 #
 # For further info, check  https://github.com/PyAr/CDPedia/
 
+import copy
 import functools
 import gettext
 import itertools
+import json
 import logging
 import os
 import posixpath
@@ -30,7 +32,9 @@ from mimetypes import guess_type
 
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import HTTPException, NotFound, InternalServerError
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import (
+    HTTPException, NotFound, InternalServerError, RequestedRangeNotSatisfiable)
 from werkzeug.utils import redirect
 from jinja2 import Environment, FileSystemLoader
 
@@ -45,7 +49,9 @@ from .test_infra import load_test_infra_data
 from .utils import TemplateManager
 
 ARTICLES_BASE_URL = "wiki"
-SEARCH_CACHE_SIZE = 100
+SEARCH_MAX_RESULTS = 100
+AUTOCOMPLETE_CACHE_SIZE = 1000
+AUTOCOMPLETE_RESULTS = 10
 
 logger = logging.getLogger(__name__)
 
@@ -65,7 +71,8 @@ class CDPedia:
         self.watchdog = watchdog
         self.verbose = verbose
 
-        self.art_mngr = compresor.ArticleManager(verbose=verbose)
+        self.art_mngr = compresor.ArticleManager(
+            verbose=verbose, cache_size=config.ARTICLES_CACHE_SIZE)
 
         # Configure template engine (jinja)
         template_path = os.path.join(os.path.dirname(__file__), 'templates')
@@ -94,6 +101,7 @@ class CDPedia:
             Rule('/al_azar', endpoint='random'),
             Rule('/search', endpoint='search', methods=['POST']),
             Rule('/search/<path:key>', endpoint='search_results'),
+            Rule('/autocomplete', endpoint='autocomplete'),
             Rule('/images/<path:name>', endpoint='image'),
             Rule('/institucional/<path:path>', endpoint='institutional'),
             Rule('/watchdog/update', endpoint='watchdog_update'),
@@ -160,7 +168,7 @@ class CDPedia:
     def on_image(self, request, name):
         try:
             normpath = posixpath.normpath(name)
-            asset_data = self.img_mngr.get_item(normpath)
+            asset_data = self.img_mngr.get_item_view(normpath)
         except Exception as err:
             msg = "Error interno al buscar imagen: %s" % err
             raise InternalServerError(msg)
@@ -178,7 +186,30 @@ class CDPedia:
             img = img_template.render(width=width, height=height, show_text=show_text)
             return Response(img, mimetype='image/svg+xml')
         type_ = guess_type(name)[0]
-        return Response(asset_data, mimetype=type_)
+        return self._image_response(request, asset_data, type_)
+
+    def _image_response(self, request, view, mimetype):
+        """Build the response with the image, or only the range of it that was requested.
+
+        The image is a view of its mapped block, so only the sent bytes are copied.
+        """
+        size = len(view)
+        content_range = None
+        if request.range is not None and len(request.range.ranges) == 1:
+            bounds = request.range.range_for_length(size)
+            if bounds is None:
+                raise RequestedRangeNotSatisfiable(length=size)
+            start, stop = bounds
+            view = view[start:stop]
+            content_range = ContentRange('bytes', start, stop, size)
+
+        # several ranges are not supported, the whole image is sent for them
+        response = Response(bytes(view), mimetype=mimetype)
+        response.accept_ranges = 'bytes'
+        if content_range is not None:
+            response.status_code = 206
+            response.content_range = content_range
+        return response
 
     def on_favicon(self, request):
         asset_file = os.path.join(config.DIR_ASSETS, 'static', 'misc', 'favicon.ico')
@@ -210,19 +241,38 @@ class CDPedia:
         link = "%s/%s" % (ARTICLES_BASE_URL, to3dirs.from_path(idx_entry.link))
         return redirect(urllib.parse.quote(link.encode("utf-8")))
 
-    @functools.lru_cache(SEARCH_CACHE_SIZE)
-    def _search(self, search_string):
-        """Really do the search."""
+    def _search(self, search_string, offset=0, limit=None):
+        """Really do the search (the index caches the results of the normalized words).
+
+        Return the page of results from offset, the total quantity of results, and if they
+        are truncated because the search took too long.
+        """
+        if limit is None:
+            limit = config.SEARCH_RESULTS
         search_string_norm = normalize_words(search_string)
         words = search_string_norm.split()
-        results = list(self.index.search(words))
 
-        # remove 3 dirs from link and add the proper base url
-        for result in results:
+        # remove 3 dirs from link and add the proper base url, in copies of the entries
+        # as the index may keep them
+        found = self.index.search(words, offset=offset, limit=limit)
+        results = []
+        for result in found:
+            result = copy.copy(result)
             result.link = "wiki/{}".format(
                 urllib.parse.quote(to3dirs.from_path(result.link), safe=()))
+            results.append(result)
+
+        return results, found.total, found.truncated
 
-        return results
+    def _render_search(self, search_string, offset=0, limit=None):
+        """Render a page of the results of the search, with links to the other pages."""
+        if limit is None:
+            limit = config.SEARCH_RESULTS
+        results, total, truncated = self._search(search_string, offset, limit)
+        search_url = "/search/{}".format(urllib.parse.quote(search_string, safe=()))
+        return self.render_template(
+            'search.html', search_string=search_string, results=results, total=total,
+            truncated=truncated, offset=offset, limit=limit, search_url=search_url)
 
     def on_search(self, request):
         """Search he received keywords in the POST request in the index."""
@@ -231,8 +281,33 @@ class CDPedia:
         if not search_string:
             return redirect("/")
 
-        results = self._search(search_string)
-        return self.render_template('search.html', search_string=search_string, results=results)
+        return self._render_search(search_string)
+
+    def on_search_results(self, request, key):
+        """Show a page of the results of searching the key, given by offset and limit."""
+        offset = max(0, request.args.get("offset", 0, type=int))
+        limit = request.args.get("limit", config.SEARCH_RESULTS, type=int)
+        limit = min(max(1, limit), SEARCH_MAX_RESULTS)
+        return self._render_search(key, offset, limit)
+
+    def _autocomplete(self, search_string):
+        """Really get the best titles for the string being typed, as JSON."""
+        return self._autocomplete_words(tuple(normalize_words(search_string).split()))
+
+    @functools.lru_cache(AUTOCOMPLETE_CACHE_SIZE)
+    def _autocomplete_words(self, words):
+        """Get the best titles for the normalized words, cached as they are the same query."""
+        results = [
+            {"title": result.title,
+             "link": "wiki/{}".format(
+                 urllib.parse.quote(to3dirs.from_path(result.link), safe=()))}
+            for result in self.index.search_prefix(list(words), AUTOCOMPLETE_RESULTS)]
+        return json.dumps(results)
+
+    def on_autocomplete(self, request):
+        """Return the best titles for the string being typed, its last word may be partial."""
+        search_string = request.args.get("q", "")
+        return Response(self._autocomplete(search_string), mimetype="application/json")
 
     def on_tutorial(self, request):
         tmpdir = os.path.join(self.tmpdir)
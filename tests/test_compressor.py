@@ -16,10 +16,18 @@
 
 """Tests for the 'compresor' module."""
 
+import concurrent.futures
+import io
+import lzma
+import os
+import pickle
+import struct
+import threading
 import urllib.parse
 
 import config
-from src.armado.compresor import ArticleManager
+from src.armado.compresor import (
+    ArticleManager, BloqueImagenes, Comprimido, ImageManager, Locator, read_at)
 
 import pytest
 
@@ -28,9 +36,11 @@ import pytest
 def test_redirects(mocker, tmp_path, filename):
     """Check that redirects are correctly registered in article block."""
 
-    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path))
+    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path / 'pages'))
     mocker.patch('config.LOG_REDIRECTS', str(tmp_path / 'redirects.txt'))
-    mocker.patch('src.armado.compresor.Comprimido')
+    mocker.patch('src.armado.compresor.ArticleManager.archive_dir', str(tmp_path / 'pages'))
+    mocker.patch('config.LANGUAGE_FILE', str(tmp_path / 'language.txt'))
+    mocker.patch('src.armado.compresor.Comprimido.crear', return_value={filename: (0, 1, 0, 1)})
     top_pages = [('f/o/o', filename, 10)]
     mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(top_pages=top_pages))
 
@@ -41,3 +51,248 @@ def test_redirects(mocker, tmp_path, filename):
     _, tot_archs, tot_redirs = ArticleManager.generar_bloques('es', None)
     assert tot_archs == 1
     assert tot_redirs == 1
+
+
+@pytest.fixture
+def articles(mocker, tmp_path):
+    """Write some articles to compress, returning their (dir3, filename) and contents."""
+    mocker.patch('config.DIR_PAGSLISTAS', str(tmp_path / 'paglistas'))
+    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path))
+    contents = {}
+    for i in range(50):
+        filename = 'Artículo_{}'.format(i)
+        contents[('a/r/t', filename)] = 'contenido {} '.format(i).encode('utf8') * ((i + 1) * 20)
+    (tmp_path / 'paglistas' / 'a' / 'r' / 't').mkdir(parents=True)
+    for (dir3, filename), content in contents.items():
+        (tmp_path / 'paglistas' / dir3 / filename).write_bytes(content)
+    return contents
+
+
+def write_old_block(fname, contents):
+    """Write a block of articles with everything compressed together, as before."""
+    header = {}
+    seek = 0
+    for (_, filename), content in contents.items():
+        header[filename] = (seek, len(content))
+        seek += len(content)
+    header_bytes = pickle.dumps(header)
+    with lzma.LZMAFile(fname, 'wb') as fh:
+        fh.write(struct.pack('<l', len(header_bytes)))
+        fh.write(header_bytes)
+        for content in contents.values():
+            fh.write(content)
+
+
+@pytest.mark.parametrize('frame_size', (1, 1000, 10 ** 9))
+def test_block_frames(mocker, tmp_path, articles, frame_size):
+    """The articles are got from the frames, of several articles or just one."""
+    mocker.patch('config.ARTICLES_FRAME_SIZE', frame_size)
+    Comprimido.crear([('Redirigido', 'Artículo_7')], 3, list(articles))
+
+    block = Comprimido(str(tmp_path / '00000003.cdp'), manager=mocker.Mock())
+    assert len(block.frame_offsets) == len(block.frame_starts) + 1
+    if frame_size == 1:
+        assert len(block.frame_starts) == len(articles)
+    elif frame_size == 10 ** 9:
+        assert len(block.frame_starts) == 1
+    for (_, filename), content in articles.items():
+        assert block.get_item(filename) == content
+    assert block.get_item('Inexistente') is None
+
+    block.get_item('Redirigido')
+    block.manager.get_item.assert_called_once_with('Artículo_7')
+
+
+def test_block_old_format(mocker, tmp_path, articles):
+    """The blocks with everything compressed together are still read."""
+    write_old_block(str(tmp_path / '00000003.cdp'), articles)
+    block = Comprimido(str(tmp_path / '00000003.cdp'))
+    assert block.frame_starts is None
+    for (_, filename), content in articles.items():
+        assert block.get_item(filename) == content
+
+
+def test_block_frames_decompress_one(mocker, tmp_path, articles):
+    """Only the frame of the article is decompressed."""
+    mocker.patch('config.ARTICLES_FRAME_SIZE', 1000)
+    Comprimido.crear([], 3, list(articles))
+    block = Comprimido(str(tmp_path / '00000003.cdp'))
+    decompressor = mocker.spy(lzma, 'LZMADecompressor')
+    assert block.get_item('Artículo_40') == articles[('a/r/t', 'Artículo_40')]
+    assert decompressor.call_count == 1
+
+
+def test_locator(tmp_path):
+    """The locations are found by the name of the items."""
+    fname = str(tmp_path / Locator.FILENAME)
+    locations = {'Artículo_{}'.format(i): (i % 7, i * 100, 50, i, i * 2) for i in range(500)}
+    Locator.create(fname, locations)
+
+    locator = Locator(fname)
+    for name, location in locations.items():
+        assert locator.find(name) == location
+    assert locator.find('Inexistente') is None
+
+
+def test_locator_empty(tmp_path):
+    """The locator may have no items at all."""
+    fname = str(tmp_path / Locator.FILENAME)
+    Locator.create(fname, {})
+    assert Locator(fname).find('Inexistente') is None
+
+
+@pytest.fixture
+def article_manager(mocker, tmp_path, articles):
+    """Generate the blocks of the articles, with a redirect."""
+    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path / 'pages'))
+    mocker.patch('src.armado.compresor.ArticleManager.archive_dir', str(tmp_path / 'pages'))
+    mocker.patch('config.LANGUAGE_FILE', str(tmp_path / 'language.txt'))
+    mocker.patch('config.LOG_REDIRECTS', str(tmp_path / 'redirects.txt'))
+    mocker.patch('config.ARTICLES_FRAME_SIZE', 1000)
+    top_pages = [(dir3, filename, 10) for dir3, filename in articles]
+    mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(top_pages=top_pages))
+    with open(config.LOG_REDIRECTS, 'w', encoding='utf-8') as fh:
+        fh.write('Redirigido|Artículo_7\n')
+    ArticleManager.generar_bloques('es', None)
+
+
+def test_manager_locator(mocker, tmp_path, articles, article_manager):
+    """The articles are got through the locator, without loading the blocks headers."""
+    manager = ArticleManager()
+    assert manager.locator is not None
+    get_block = mocker.patch.object(manager, 'getBloque')
+    for (_, filename), content in articles.items():
+        assert manager.get_item(filename) == content.decode('utf8')
+    assert manager.get_item('Redirigido') == articles[('a/r/t', 'Artículo_7')].decode('utf8')
+    assert manager.get_item('Inexistente') is None
+    get_block.assert_not_called()
+
+
+def test_manager_without_locator(mocker, tmp_path, articles, article_manager):
+    """The articles are got from the blocks headers if there is no locator."""
+    os.remove(str(tmp_path / 'pages' / Locator.FILENAME))
+    manager = ArticleManager()
+    assert manager.locator is None
+    for (_, filename), content in articles.items():
+        assert manager.get_item(filename) == content.decode('utf8')
+    assert manager.get_item('Redirigido') == articles[('a/r/t', 'Artículo_7')].decode('utf8')
+    assert manager.get_item('Inexistente') is None
+
+
+@pytest.fixture
+def images(mocker, tmp_path):
+    """Generate the blocks of some images, returning their contents."""
+    mocker.patch('src.armado.compresor.ImageManager.archive_dir', str(tmp_path / 'images'))
+    mocker.patch('config.DIR_IMAGES_BLOCKS', str(tmp_path / 'images'))
+    mocker.patch('config.DIR_IMGSLISTAS', str(tmp_path / 'imglistas'))
+    images = {}
+    for i in range(30):
+        name = os.path.join('a', 'b', 'imagen_{}.png'.format(i))
+        images[name] = bytes(range(i, 256)) * 3
+    for name, content in images.items():
+        path = tmp_path / 'imglistas' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    ImageManager.generar_bloques(None)
+    return images
+
+
+def test_image_manager_locator(images):
+    """The images are got through the locator, read directly from the blocks."""
+    manager = ImageManager()
+    assert manager.locator is not None
+    for name, content in images.items():
+        assert manager.get_item(name) == content
+    assert manager.get_item('inexistente.png') is None
+
+
+def test_manager_cache(mocker, tmp_path, articles, article_manager):
+    """The articles got are cached, so they are decompressed only once."""
+    manager = ArticleManager(cache_size=10 ** 6)
+    decode = mocker.spy(Comprimido, 'decode')
+    content = articles[('a/r/t', 'Artículo_40')].decode('utf8')
+    for _ in range(3):
+        assert manager.get_item('Artículo_40') == content
+    assert decode.call_count == 1
+    assert manager.cache.stats()['hits'] == 2
+    assert manager.get_item('Inexistente') is None
+    assert manager.cache.stats()['entries'] == 1
+
+
+@pytest.mark.parametrize('use_locator', (True, False))
+def test_manager_cache_redirects(mocker, tmp_path, articles, article_manager, use_locator):
+    """The redirects share the cached article of their target."""
+    manager = ArticleManager(cache_size=10 ** 6)
+    if not use_locator:
+        manager.locator = None
+    content = articles[('a/r/t', 'Artículo_7')].decode('utf8')
+    assert manager.get_item('Redirigido') == content
+    assert manager.get_item('Artículo_7') == content
+    assert manager.get_item('Redirigido') == content
+    assert manager.cache.stats()['entries'] == 1
+
+
+def test_manager_cache_disabled(mocker, tmp_path, articles, article_manager):
+    """By default nothing is cached."""
+    manager = ArticleManager()
+    decode = mocker.spy(Comprimido, 'decode')
+    assert manager.get_item('Artículo_40') == manager.get_item('Artículo_40')
+    assert decode.call_count == 2
+    assert manager.cache.stats() == {
+        'hits': 0, 'misses': 2, 'evictions': 0, 'entries': 0, 'bytes': 0}
+
+
+@pytest.mark.parametrize('use_locator', (True, False))
+def test_image_concurrent_reads(tmp_path, images, use_locator):
+    """The images of the same block are read at the same time from several threads."""
+    manager = ImageManager()
+    if not use_locator:
+        manager.locator = None
+    names = sorted(images) * 20
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        got = list(executor.map(manager.get_item, names))
+    assert got == [images[name] for name in names]
+
+
+def test_article_concurrent_reads(mocker, tmp_path, articles):
+    """The articles of the same block are read at the same time from several threads."""
+    mocker.patch('config.ARTICLES_FRAME_SIZE', 1000)
+    Comprimido.crear([], 3, list(articles))
+    write_old_block(str(tmp_path / '00000004.cdp'), articles)
+    filenames = [filename for _, filename in articles] * 10
+    for fname in ('00000003.cdp', '00000004.cdp'):
+        block = Comprimido(str(tmp_path / fname))
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            got = list(executor.map(block.get_item, filenames))
+        assert got == [articles[('a/r/t', filename)] for filename in filenames]
+
+
+def test_read_at_without_pread(monkeypatch):
+    """Without positional reads the file is read under the lock."""
+    monkeypatch.delattr(os, 'pread', raising=False)
+    fh = io.BytesIO(b'0123456789')
+    assert read_at(fh, threading.Lock(), 3, 4) == b'3456'
+
+
+def test_image_block_read_at(mocker, tmp_path, images):
+    """The image block reads its images without moving the file cursor."""
+    block_name = sorted(os.listdir(str(tmp_path / 'images')))[0]
+    block = BloqueImagenes(str(tmp_path / 'images' / block_name))
+    position = block.fh.tell()
+    for name in block.header:
+        assert block.get_item(name) == images[name]
+    if hasattr(os, 'pread'):
+        assert block.fh.tell() == position
+
+
+@pytest.mark.parametrize('use_locator', (True, False))
+def test_image_views(tmp_path, images, use_locator):
+    """The images are got as views of the mapped blocks."""
+    manager = ImageManager()
+    if not use_locator:
+        manager.locator = None
+    for name, content in images.items():
+        view = manager.get_item_view(name)
+        assert isinstance(view, memoryview)
+        assert view == content
+    assert manager.get_item_view('inexistente.png') is None
@@ -27,6 +27,15 @@ def test_delta_encode_decode():
     encoded = docset.delta_encode(values)
     assert values == docset.delta_decode(encoded)
 
+
+@pytest.mark.parametrize('step', [1, 3, 200, 20000])
+def test_delta_encode_decode_big(step):
+    """Test encoding and decoding big buckets, dense and sparse."""
+    values = list(range(5, 300 * step, step))
+    values[100] += 1
+    encoded = sqlite_index.DocSet.delta_encode(values)
+    assert values == sqlite_index.DocSet.delta_decode(encoded)
+
 # --- Test the DocSet class
 
 
@@ -79,6 +88,137 @@ def test_encode_decode_docset():
     assert docset == docset2
 
 
+def test_decode_docids():
+    """Test decoding only the docids of an encoded DocSet."""
+    docset = sqlite_index.DocSet()
+    data = {123: 12, 234: 1, 56: 5, 432: 9}
+    for k, v in data.items():
+        docset.append(k, v)
+    docset.append(123, 2)
+    encoded = docset.encode()
+    assert sqlite_index.DocSet.decode_docids(encoded) == [56, 123, 123, 234, 432]
+    assert sqlite_index.DocSet.decode_docids(sqlite_index.DocSet().encode()) == []
+
+
+def test_decode_arrays():
+    """Test decoding an encoded DocSet into arrays."""
+    docset = sqlite_index.DocSet()
+    data = {123: 12, 234: 1, 56: 5, 432: 9}
+    for k, v in data.items():
+        docset.append(k, v)
+    docset.append(123, 2)
+    docids, positions = sqlite_index.DocSet.decode_arrays(docset.encode())
+    assert list(docids) == [56, 123, 123, 234, 432]
+    assert list(positions) == [5, 2, 12, 1, 9]
+
+
+def get_big_docset():
+    """Create a DocSet with skips, some docids repeated around the skips."""
+    docset = sqlite_index.DocSet()
+    for docid in range(0, 3000, 7):
+        docset.append(docid, docid % 11)
+    for docid in (7 * 127, 7 * 128, 7 * 255):
+        docset.append(docid, 200)
+        docset.append(docid, 201)
+    return docset
+
+
+def test_encode_decode_skips():
+    """Test encode & decode a big DocSet, with skips."""
+    docset = get_big_docset()
+    encoded = docset.encode()
+    assert sqlite_index.DocSet.has_skips(encoded)
+    assert sqlite_index.DocSet.decode(encoded) == docset
+    docids = sorted(docid for docid, positions in docset.items() for _ in positions)
+    assert sqlite_index.DocSet.decode_docids(encoded) == docids
+    arr_docids, positions = sqlite_index.DocSet.decode_arrays(encoded)
+    assert list(arr_docids) == docids
+    assert list(positions) == [
+        position for docid, positions in sorted(docset.items()) for position in sorted(positions)]
+
+
+def test_small_docsets_without_skips():
+    """Small DocSets are encoded as always, without skips."""
+    docset = sqlite_index.DocSet()
+    for docid in range(sqlite_index.SKIP_INTERVAL):
+        docset.append(docid, 1)
+    assert not sqlite_index.DocSet.has_skips(docset.encode())
+    assert not sqlite_index.DocSet.has_skips(sqlite_index.DocSet().encode())
+
+
+def test_decode_unknown_version():
+    """Encoded DocSets of unknown versions are not decoded."""
+    encoded = get_big_docset().encode()
+    encoded = encoded[:1] + b"\x09" + encoded[2:]
+    with pytest.raises(ValueError):
+        sqlite_index.DocSet.decode(encoded)
+
+
+@pytest.mark.parametrize('candidates', [
+    [],
+    [0],
+    [1, 2, 3],
+    [7 * 127, 7 * 128, 7 * 129, 7 * 255],
+    [6, 7 * 128 - 1, 7 * 128 + 1, 2996, 2997, 10000],
+    list(range(0, 3500, 5)),
+])
+def test_probe(candidates):
+    """Test probing the candidates that are in a DocSet, jumping with its skips."""
+    encoded = get_big_docset().encode()
+    expected = sorted(set(candidates) & set(sqlite_index.DocSet.decode_docids(encoded)))
+    assert sqlite_index.DocSet.probe(encoded, candidates) == expected
+
+
+@pytest.mark.parametrize('quantity, below, expected', [
+    (3, None, [0, 7, 14]),
+    (200, None, list(range(0, 1400, 7))),
+    (1000, None, list(range(0, 3000, 7))),
+    (3, 1, [0, 7, 14]),
+    (3, 0, []),
+])
+def test_first_docids(quantity, below, expected):
+    """Test decoding only the first docids of a DocSet."""
+    encoded = get_big_docset().encode()
+    assert sqlite_index.DocSet.first_docids(encoded, quantity, below) == expected
+
+
+def test_first_docids_repeated():
+    """The first docids are different, even if repeated by position in a small DocSet."""
+    docset = sqlite_index.DocSet()
+    for docid in (3, 3, 3, 5, 800, 800, 100000):
+        docset.append(docid, 1)
+    encoded = docset.encode()
+    assert sqlite_index.DocSet.first_docids(encoded, 3) == [3, 5, 800]
+    assert sqlite_index.DocSet.first_docids(encoded, 9) == [3, 5, 800, 100000]
+
+
+@pytest.mark.parametrize('docids1, docids2', [
+    ([], [1, 2, 3]),
+    ([2, 5, 7], [1, 2, 3, 5, 8]),
+    ([3, 500, 501, 9999], list(range(0, 1000, 3))),
+    (list(range(0, 1000, 3)), [0, 1, 2, 999, 2000]),
+])
+def test_intersect_sorted(docids1, docids2):
+    """Test intersecting sorted docids, also galloping over the bigger one."""
+    expected = sorted(set(docids1) & set(docids2))
+    assert sqlite_index.intersect_sorted(docids1, docids2) == expected
+
+
+@pytest.mark.parametrize('word1, word2, distance', [
+    ("casa", "casa", 0),
+    ("argentia", "argentina", 1),
+    ("argnetina", "argentina", 1),
+    ("cosa", "casa", 1),
+    ("kitten", "sitting", 3),
+    ("", "abc", 3),
+    ("abc", "ca", 3),
+])
+def test_edit_distance(word1, word2, distance):
+    """Test the edit distance, counting the transpositions as one edit."""
+    assert sqlite_index.edit_distance(word1, word2) == distance
+    assert sqlite_index.edit_distance(word2, word1) == distance
+
+
 def test_empty_docsets():
     """Test encode & decode an empty DocSet."""
     docset = sqlite_index.DocSet()
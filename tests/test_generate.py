@@ -0,0 +1,61 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+
+"""Tests for the 'generate' module."""
+
+import config
+from src.armado import cdpindex
+from tests.utils import load_run_config
+
+import pytest
+
+
+@pytest.fixture
+def run_config(mocker, tmp_path):
+    """The config used on the final user computer."""
+    return load_run_config(mocker, tmp_path)
+
+
+def test_run_config_index_server_mode(run_config):
+    """The index is read as configured for the server deployments."""
+    assert run_config.INDEX_MMAP == config.INDEX_MMAP
+    assert run_config.INDEX_PRELOAD == config.INDEX_PRELOAD
+
+
+def test_run_config_index_cache(run_config):
+    """The searches cache of the index has the configured size."""
+    assert run_config.INDEX_QUERY_CACHE_SIZE == config.INDEX_QUERY_CACHE_SIZE
+
+
+@pytest.mark.parametrize('timeout', [None, 1.0])
+def test_run_config_index(mocker, tmp_path, timeout):
+    """The index is opened with the generated config."""
+    mocker.patch('config.INDEX_SEARCH_TIMEOUT', timeout)
+    run_config = load_run_config(mocker, tmp_path)
+    assert run_config.INDEX_SEARCH_TIMEOUT == timeout
+    assert run_config.INDEX_SEARCH_MAX_SCORED == config.INDEX_SEARCH_MAX_SCORED
+
+    mocker.patch('src.armado.cdpindex.config', run_config)
+    cdpindex.Index.create(str(tmp_path), [('Page1', 'p/a/g/page1', 7, ' ', ['key1'], set())])
+    index = cdpindex.IndexInterface(str(tmp_path))
+    index.run()
+    assert index.ready.is_set()
+    assert index.index.search_timeout == timeout
+
+
+def test_run_config_articles_cache(run_config):
+    """The articles cache has the configured size."""
+    assert run_config.ARTICLES_CACHE_SIZE == config.ARTICLES_CACHE_SIZE
@@ -15,6 +15,14 @@
 # For further info, check  https://github.com/PyAr/CDPedia/
 
 
+import concurrent.futures
+import itertools
+import lzma
+import os
+import pickle
+import sqlite3
+import time
+
 import pytest
 
 from src.armado import sqlite_index
@@ -36,6 +44,11 @@ def to_idx_data(titles):
     return [[ttl.strip(), ttl.strip(), 0, '', tokenize(ttl), set()] for ttl in titles]
 
 
+def open_writable(idx):
+    """Open a connection to modify the database of the index."""
+    return sqlite3.connect(os.path.join(idx._directory, "index.sqlite"))
+
+
 @pytest.fixture()
 def create_index(tmpdir):
     """Create an index with given info in a temp dir, load it and return built index."""
@@ -92,6 +105,44 @@ def test_random_several_values(create_index):
     value = list([idx.random()])[0]
     assert value in {get_ie('ala blanca'), get_ie('conejo blanco'), get_ie('conejo negro')}
 
+
+def test_random_by_score(create_index, mocker):
+    """The original articles are chosen by their score, never the redirects."""
+    data = to_idx_data(["ala blanca", "conejo blanco", "conejo negro"])
+    data[0][2] = 3
+    data[1][2] = 1
+    data[2][-1] = {("conejo", "oscuro")}
+    idx = create_index(data)
+    assert idx.use_articles
+    assert idx.meta['article_count'] == '3'
+
+    # each possible draw of the cumulative weights (the scores, at least 1)
+    mocker.patch.object(sqlite_index.random, 'randrange', side_effect=range(5))
+    titles = [idx.random().title for _ in range(5)]
+    assert titles == ["ala blanca"] * 3 + ["conejo blanco", "conejo negro"]
+
+
+def test_random_gets_one_doc(create_index, mocker):
+    """Only the chosen doc is got."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    idx.random()
+    get_doc = mocker.spy(idx, 'get_doc')
+    assert idx.random() in set(idx.values())
+    assert get_doc.call_count == 1
+
+
+def test_random_old_index(create_index):
+    """Indexes without the original articles give any doc."""
+    data = to_idx_data(["ala blanca", "conejo blanco"])
+    data[0][-1] = {("ala", "clara")}
+    idx = create_index(data)
+    with open_writable(idx) as db:
+        db.execute("DROP TABLE articles")
+    idx = sqlite_index.Index(idx._directory)
+    assert not idx.use_articles
+    titles = {idx.random().title for _ in range(100)}
+    assert titles <= {"ala blanca", "conejo blanco"}
+
 # --- Test the "in" functionality.
 
 
@@ -212,3 +263,686 @@ def test_redir(create_index):
     idx_entry.rtype = IndexEntry.TYPE_REDIRECT
     idx_entry.subtitle = "zzz xxx"
     assert set(res) == {idx_entry}
+
+
+# --- Test the n-grams search.
+
+
+@pytest.mark.parametrize('key', [
+    "a", "bl", "bla", "blan", "lanc", "onej", "x", "zzzz", "o_o", "%"])
+def test_ngrams_same_as_like(create_index, key):
+    """The n-grams search gives the same results than the full scan of the tokens table."""
+    data = ["ala blanca", "conejo blanco", "conejo negro", "ab", "blancanieves", "o_o"]
+    idx = create_index(to_idx_data(data))
+    assert idx.use_ngrams
+    search = sqlite_index.Search(idx.db, [key], use_ngrams=True, use_tokenids=True)
+    by_ngrams = list(search._fetch(key))
+    by_like = list(sqlite_index.Search(idx.db, [key], use_ngrams=False)._fetch(key))
+    assert by_ngrams == by_like
+
+
+def test_ngrams_old_index(create_index):
+    """Indexes without the n-grams table are still searched."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    with open_writable(idx) as db:
+        db.execute("DROP TABLE ngrams")
+    idx = sqlite_index.Index(idx._directory)
+    assert not idx.use_ngrams
+    res = idx.search(["blanc"])
+    assert set(res) == {get_ie('ala blanca'), get_ie('conejo blanco')}
+
+
+# --- Test the search plan.
+
+
+def test_plan_rarest_first(create_index, mocker):
+    """The rarest key is decoded first, and a common key is only probed for its results."""
+    data = ["de la {}".format(i) for i in range(100)] + ["historia de la argentina"]
+    idx = create_index(to_idx_data(data))
+    assert idx.use_docfreq
+    spy = mocker.spy(sqlite_index.DocSet, 'decode_docids')
+    search = sqlite_index.Search(idx.db, ["de", "historia"], use_ngrams=True, use_docfreq=True,
+                                 use_tokenids=True)
+    assert search.results == [100]
+    assert spy.call_args_list[0] == mocker.call(idx.db.execute(
+        "SELECT docsets FROM tokens WHERE word = 'historia'").fetchone()[0])
+
+
+def test_plan_probes_with_skips(create_index, mocker):
+    """The big docsets are probed jumping with their skips, with the same results."""
+    data = ["de la {}".format(i) for i in range(1000)] + ["historia de la argentina"]
+    idx = create_index(to_idx_data(data))
+    spy = mocker.spy(sqlite_index.DocSet, 'probe')
+    search = sqlite_index.Search(idx.db, ["historia", "de"], use_ngrams=True, use_docfreq=True,
+                                 use_tokenids=True)
+    assert search.results == [1000]
+    assert spy.call_count == 1
+    res = idx.search(["historia", "de"])
+    assert set(res) == {get_ie('historia de la argentina')}
+
+
+def test_plan_discards_words(create_index):
+    """The words of a key without hits in the results are not kept."""
+    idx = create_index(to_idx_data(["casa blanca", "casas blancas", "casamiento"]))
+    search = sqlite_index.Search(idx.db, ["blanca", "casa"], use_ngrams=True, use_docfreq=True,
+                                 use_tokenids=True)
+    assert sorted(word for word, _ in search.matches) == [
+        "blanca", "blancas", "casa", "casas"]
+
+
+def test_plan_old_index(create_index):
+    """Indexes without the documents frequency are still planned, by the docsets size."""
+    data = ["ala blanca", "conejo blanco", "conejo negro"]
+    idx = create_index(to_idx_data(data))
+    open_writable(idx).executescript("""
+        CREATE TABLE old_tokens AS SELECT word, docsets FROM tokens;
+        DROP TABLE tokens;
+        ALTER TABLE old_tokens RENAME TO tokens;
+        """)
+    idx = sqlite_index.Index(idx._directory)
+    assert not idx.use_docfreq
+    res = idx.search(["blanc", "conejo"])
+    assert set(res) == {get_ie('conejo blanco')}
+
+
+# --- Test the results ordering.
+
+
+def test_ordered_same_as_full_sort(create_index):
+    """The lazy ordering gives the same results than scoring and sorting everything."""
+    data = ["blanca {}".format(" ".join(["x"] * (i % 7))) for i in range(300)]
+    data += ["casa blanca", "blanca", "blancanieves"]
+    idx = create_index(to_idx_data(data))
+    search = sqlite_index.Search(idx.db, ["blanca"], use_ngrams=True, use_tokenids=True)
+    expected = sorted(((search._score(docid), docid) for docid in search.results), reverse=True)
+    search = sqlite_index.Search(idx.db, ["blanca"], use_ngrams=True, use_tokenids=True)
+    assert list(search.ordered()) == expected
+    assert expected[0][1] == [entry.title for entry in idx.values()].index("blanca")
+
+
+def test_ordered_stops_scoring(create_index, mocker):
+    """Only the needed documents are scored when the first results are consumed."""
+    idx = create_index(to_idx_data(["blanca {}".format(i) for i in range(1000)]))
+    search = sqlite_index.Search(idx.db, ["blanca"], use_ngrams=True, use_tokenids=True)
+    spy = mocker.spy(search, '_score')
+    first = [docid for _, docid in itertools.islice(search.ordered(), 10)]
+    assert first == list(range(10))
+    assert spy.call_count < 100
+
+
+# --- Test the docs pages.
+
+
+def test_docs_page_encode_decode():
+    """Test encoding the entries in a page and decoding them."""
+    entries = [
+        get_ie("ala blanca"),
+        IndexEntry(rtype=IndexEntry.TYPE_ORIG_SIMPLE_LINK, link=None, title="Ñandú común",
+                   score=123456789012, description="ave\nsudamericana"),
+        IndexEntry(rtype=IndexEntry.TYPE_REDIRECT, link=None, title=None, subtitle="rhea",
+                   orig_docid=1),
+    ]
+    page = sqlite_index.DocsPage.encode(entries)
+    assert sqlite_index.DocsPage.length(page) == 3
+    assert sqlite_index.DocsPage.decode(page, 1) == entries[1]
+    assert sqlite_index.DocsPage.decode_all(page) == entries
+    with pytest.raises(IndexError):
+        sqlite_index.DocsPage.decode(page, 3)
+
+
+def test_docs_pickled_old_index(create_index):
+    """Indexes with pickled docs pages are still read."""
+    data = ["ala blanca", "conejo blanco", "conejo negro"]
+    idx = create_index(to_idx_data(data))
+    db = open_writable(idx)
+    rows = db.execute("SELECT pageid, word_quants, records FROM docs").fetchall()
+    db.executescript("""
+        DROP TABLE docs;
+        CREATE TABLE docs (pageid INTEGER PRIMARY KEY, word_quants BLOB, data BLOB);
+        """)
+    for pageid, word_quants, records in rows:
+        entries = sqlite_index.DocsPage.decode_all(lzma.decompress(records))
+        db.execute("INSERT INTO docs VALUES (?, ?, ?)",
+                   (pageid, word_quants, lzma.compress(pickle.dumps(entries))))
+    db.commit()
+    idx = sqlite_index.Index(idx._directory)
+    assert not idx.use_records
+    assert len(idx) == 3
+    assert list(idx.values()) == [get_ie(title) for title in data]
+    assert set(idx.search(["blanc"])) == {get_ie('ala blanca'), get_ie('conejo blanco')}
+
+
+@pytest.mark.parametrize('codec', sorted(sqlite_index.CODECS))
+def test_docs_codecs_page_sizes(tmpdir, codec):
+    """The index is built and read with every codec, and pages of any size."""
+    data = ["ala blanca", "conejo blanco", "conejo negro", "blanca nieves", "blanco"]
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(data), codec=codec, page_size=2)
+    idx = sqlite_index.Index(str(tmpdir))
+    assert idx.meta['codec'] == codec
+    assert idx.page_size == 2
+    assert len(idx) == 5
+    assert list(idx.values()) == [get_ie(title) for title in data]
+    assert set(idx.search(["blanc"])) == {
+        get_ie('ala blanca'), get_ie('conejo blanco'), get_ie('blanca nieves'),
+        get_ie('blanco')}
+
+
+def test_docs_unknown_codec(tmpdir):
+    """The index can't be built with an unknown codec."""
+    with pytest.raises(ValueError):
+        sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]), codec="zip")
+
+
+def test_docs_old_index_without_meta(create_index):
+    """Indexes without metadata are read with the default codec and page size."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    with open_writable(idx) as db:
+        db.execute("DROP TABLE meta")
+    idx = sqlite_index.Index(idx._directory)
+    assert idx.meta['codec'] == sqlite_index.DEFAULT_CODEC
+    assert idx.page_size == sqlite_index.PAGE_SIZE
+    assert set(idx.search(["blanc"])) == {get_ie('ala blanca'), get_ie('conejo blanco')}
+
+
+# --- Test the index metadata.
+
+
+def test_meta(create_index, mocker):
+    """The metadata has the build parameters and figures, without decompressing pages."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    assert idx.meta['format_version'] == str(sqlite_index.FORMAT_VERSION)
+    assert idx.meta['doc_count'] == '3'
+    assert idx.meta['token_count'] == '5'
+    assert float(idx.meta['build_time_total']) >= float(idx.meta['build_time_docs'])
+    spy = mocker.spy(idx, '_get_page')
+    assert len(idx) == 3
+    assert idx.random() in {
+        get_ie('ala blanca'), get_ie('conejo blanco'), get_ie('conejo negro')}
+    assert spy.call_count == 1
+
+
+def test_meta_len_old_index(create_index):
+    """Indexes without metadata still count their documents."""
+    data = ["blanca {}".format(i) for i in range(600)]
+    idx = create_index(to_idx_data(data))
+    with open_writable(idx) as db:
+        db.execute("DROP TABLE meta")
+    idx = sqlite_index.Index(idx._directory)
+    assert 'doc_count' not in idx.meta
+    assert len(idx) == 600
+
+
+def test_meta_newer_format(create_index):
+    """Indexes of a newer format are detected when opening them."""
+    idx = create_index(to_idx_data(["ala blanca"]))
+    with open_writable(idx) as db:
+        db.execute("UPDATE meta SET value = ? WHERE key = 'format_version'",
+                   (str(sqlite_index.FORMAT_VERSION + 1),))
+    with pytest.raises(ValueError):
+        sqlite_index.Index(idx._directory)
+
+
+# --- Test the connections pool.
+
+
+def test_pool_connections(tmp_path):
+    """Connections are opened when all are in use, and only some are kept idle."""
+    pool = sqlite_index.ConnectionPool(
+        str(tmp_path / "test.sqlite"), "PRAGMA query_only = True;", size=2)
+    with pool.connection() as con1:
+        with pool.connection() as con2:
+            with pool.connection() as con3:
+                assert len({id(con1), id(con2), id(con3)}) == 3
+    assert pool._idle.qsize() == 2
+    with pool.connection() as con:
+        assert con in (con2, con3)
+    assert pool.execute("PRAGMA query_only").fetchone() == (1,)
+    pool.close()
+    assert pool._idle.qsize() == 0
+
+
+def test_concurrent_searches(create_index):
+    """The index is searched from several threads at the same time."""
+    data = ["blanca {} {}".format(word, i) for i in range(300) for word in ("ala", "casa")]
+    idx = create_index(to_idx_data(data))
+    expected = [list(idx.search(["blanca", key])) for key in ("ala", "casa", "blanc")]
+
+    def search(i):
+        key = ("ala", "casa", "blanc")[i % 3]
+        return list(idx.search(["blanca", key]))
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(search, range(60)))
+    assert results == [expected[i % 3] for i in range(60)]
+
+
+# --- Test the server modes.
+
+
+@pytest.mark.parametrize('mmap, preload', [(True, False), (False, True), (True, True)])
+def test_server_modes(create_index, mmap, preload, mocker, caplog):
+    """The index gives the same results when read at startup, and maybe kept in memory."""
+    data = ["blanca {} {}".format(word, i) for i in range(600) for word in ("ala", "casa")]
+    default_idx = create_index(to_idx_data(data))
+    caplog.set_level('INFO')
+    idx = sqlite_index.Index(default_idx._directory, mmap=mmap, preload=preload)
+    assert "reading deletes tokenids" in caplog.text
+    # the articles for the random ones are already loaded
+    execute = mocker.spy(idx.db, 'execute')
+    idx.random()
+    assert not any('articles' in call[0][0] for call in execute.call_args_list)
+    # preload implies mmap, to have also the tokens in memory
+    assert idx.db.execute("PRAGMA mmap_size").fetchone()[0] > 0
+    spy = mocker.spy(idx, '_load_page')
+    assert len(idx) == len(data)
+    assert list(idx.values()) == list(default_idx.values())
+    for keys in (["blanca", "ala"], ["casa", "1"], ["ala"]):
+        assert list(idx.search(keys)) == list(default_idx.search(keys))
+    assert idx.get_doc(1000) == default_idx.get_doc(1000)
+    if preload:
+        # the docs were not loaded again
+        assert spy.call_count == 0
+
+
+# --- Test the bounded memory build.
+
+
+@pytest.mark.parametrize('run_size', [1, 3, 100])
+def test_external_sort(tmp_path, run_size):
+    """The items are sorted as with sorted, keeping the order of the equal ones."""
+    items = [(i % 7, i) for i in range(50)]
+    quantity, result = sqlite_index.external_sort(
+        items, str(tmp_path), run_size, key=lambda item: item[0], reverse=True)
+    assert quantity == 50
+    assert list(result) == sorted(items, key=lambda item: item[0], reverse=True)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_build_spilling_runs(tmp_path, monkeypatch):
+    """The index built by runs spilled to disk is the same as the one built in memory."""
+    data = to_idx_data("blanca {} {}".format(word, i) for i in range(300)
+                       for word in ("ala", "casa", "nieves"))
+    for i, item in enumerate(data):
+        item[2] = i % 11
+        item[5] = {("nieve", str(i))} if i % 5 else set()
+    sqlite_index.Index.create(str(tmp_path), data)
+    default_idx = sqlite_index.Index(str(tmp_path))
+
+    monkeypatch.setattr(sqlite_index, 'SORT_RUN_SIZE', 50)
+    monkeypatch.setattr(sqlite_index, 'TOKENS_RUN_SIZE', 100)
+    runs_path = tmp_path / "runs"
+    runs_path.mkdir()
+    sqlite_index.Index.create(str(runs_path), data)
+    idx = sqlite_index.Index(str(runs_path))
+
+    assert int(idx.meta['build_tokens_runs']) > 1
+    assert float(idx.meta['build_peak_rss_mb']) > 0
+    assert sorted(os.listdir(str(runs_path))) == ["index.sqlite"]
+    assert list(idx.values()) == list(default_idx.values())
+    assert dict(idx.db.execute("SELECT word, docsets FROM tokens").fetchall()) == dict(
+        default_idx.db.execute("SELECT word, docsets FROM tokens").fetchall())
+    for keys in (["blanca", "ala"], ["casa", "1"], ["nieve"], ["niev", "2"]):
+        assert list(idx.search(keys)) == list(default_idx.search(keys))
+
+
+# --- Test the parallel build.
+
+
+def test_build_parallel(tmp_path):
+    """The index built with several workers has the same tables as the sequential one."""
+    data = to_idx_data("blanca {} {}".format(word, i) for i in range(300)
+                       for word in ("ala", "casa", "nieves"))
+    for i, item in enumerate(data):
+        item[2] = i % 11
+        item[5] = {("nieve", str(i))} if i % 5 else set()
+    dumps = {}
+    for workers in (1, 3):
+        path = tmp_path / str(workers)
+        path.mkdir()
+        sqlite_index.Index.create(str(path), data, page_size=16, workers=workers)
+        idx = sqlite_index.Index(str(path))
+        assert idx.meta['build_workers'] == str(workers)
+        dumps[workers] = [
+            idx.db.execute("SELECT * FROM {} ORDER BY 1".format(table)).fetchall()
+            for table in ("docs", "tokens", "ngrams")]
+    assert dumps[1] == dumps[3]
+
+
+# --- Test the tokens clustered by word.
+
+
+def test_tokens_clustered(create_index):
+    """The tokens are looked up by word directly, and the build is analyzed."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    assert idx.use_tokenids
+    assert list(idx.keys()) == sorted(idx.keys())
+    plan = idx.db.execute(
+        "EXPLAIN QUERY PLAN SELECT word FROM tokens WHERE word = 'ala'").fetchall()
+    assert "PRIMARY KEY" in plan[0][-1]
+    assert "blanca" in idx
+    assert "blan" not in idx
+    assert idx.db.execute("SELECT count(*) FROM sqlite_stat1").fetchone()[0] > 0
+
+
+def test_tokens_old_index(create_index):
+    """Indexes with the tokens in a rowid table are still searched through the n-grams."""
+    data = ["ala blanca", "conejo blanco", "conejo negro"]
+    idx = create_index(to_idx_data(data))
+    expected = [list(idx.search(keys)) for keys in (["blanc"], ["conej", "negro"], ["a"])]
+    open_writable(idx).executescript("""
+        CREATE TABLE old_tokens AS SELECT word, docsets, docfreq FROM tokens ORDER BY tokenid;
+        DROP TABLE tokens;
+        ALTER TABLE old_tokens RENAME TO tokens;
+        CREATE INDEX idx_words ON tokens (word);
+        """)
+    idx = sqlite_index.Index(idx._directory)
+    assert not idx.use_tokenids
+    assert idx.use_ngrams
+    assert [list(idx.search(keys)) for keys in (["blanc"], ["conej", "negro"], ["a"])] == expected
+    assert "blanca" in idx
+
+
+# --- Test the prefix search.
+
+
+def test_prefix_best_scored(create_index):
+    """The best scored docs with a word starting with the last key are given."""
+    data = to_idx_data(["blanca nieves", "blanco", "blancura", "ala blanca", "negro"])
+    for item, score in zip(data, (5, 9, 1, 3, 10)):
+        item[2] = score
+    idx = create_index(data)
+    assert [e.title for e in idx.search_prefix(["blan"], 10)] == [
+        "blanco", "blanca nieves", "ala blanca", "blancura"]
+    assert [e.title for e in idx.search_prefix(["Blan"], 2)] == ["blanco", "blanca nieves"]
+    assert [e.title for e in idx.search_prefix(["ala", "b"], 10)] == ["ala blanca"]
+    assert [e.title for e in idx.search_prefix(["blanca", "n"], 10)] == ["blanca nieves"]
+    assert idx.search_prefix(["lanc"], 10) == []
+    assert idx.search_prefix(["nieve", "b"], 10) == []
+    assert idx.search_prefix([], 10) == []
+
+
+def test_prefix_many_redirects(create_index):
+    """The redirects of a popular article don't take the place of other articles."""
+    data = to_idx_data(["Argentina"] + ["Argentino {}".format(i) for i in range(15)])
+    data[0][2] = 100
+    data[0][5] = {("argentinos", str(i)) for i in range(25)}
+    idx = create_index(data)
+    titles = [e.title for e in idx.search_prefix(["arg"], 10)]
+    assert titles == ["Argentina"] + ["Argentino {}".format(i) for i in range(9)]
+
+
+@pytest.mark.parametrize('prefix', [chr(0x10FFFF), "a" + chr(0x10FFFF), chr(0xD7FF)])
+def test_prefix_last_chars(create_index, prefix):
+    """The prefixes ending in the last unicode chars are searched."""
+    idx = create_index(to_idx_data(["blanca nieves"]))
+    assert idx.search_prefix([prefix], 10) == []
+
+
+@pytest.mark.parametrize('prefix, end', [
+    ("abc", "abd"), ("a" + chr(0x10FFFF), "b"), (chr(0x10FFFF) * 2, None),
+    ("a" + chr(0xD7FF), "a" + chr(0xE000))])
+def test_prefix_end(prefix, end):
+    """The first string after the ones with the prefix is computed."""
+    assert sqlite_index.prefix_end(prefix) == end
+
+
+@pytest.mark.parametrize('keys', [
+    ["b"], ["bl"], ["blanca", "c"], ["x"], ["c", "1"], ["cielo", "1"], ["blanca", "casa", "1"]])
+def test_prefix_same_as_full_scan(create_index, keys):
+    """The prefix search gives the same docs than checking all the words."""
+    data = to_idx_data("blanca {} {} {}".format(word, i % 13, i) for i in range(1200)
+                       for word in ("casa", "blanco", "cielo"))
+    for i, item in enumerate(data):
+        item[2] = (i * 7919) % 1000
+        item[5] = {("bla", str(i))} if i % 4 else set()
+    idx = create_index(data)
+
+    words = dict(idx.items())
+    docids = set(itertools.chain.from_iterable(
+        docset._docs_list for word, docset in words.items() if word.startswith(keys[-1])))
+    for word in keys[:-1]:
+        docids &= set(words[word]._docs_list) if word in words else set()
+    expected = []
+    links = set()
+    for docid in sorted(docids):
+        entry = idx.get_doc(docid)
+        if entry.link not in links:
+            links.add(entry.link)
+            expected.append(entry)
+    assert idx.search_prefix(keys, 15) == expected[:15]
+
+
+# --- Test the correction of misspelled keys.
+
+
+def test_fuzzy_words(create_index):
+    """The closest words are given first, and then the commonest."""
+    data = ["historia argentina", "argentino", "argentino", "argentinas", "casa", "cosas"]
+    idx = create_index(to_idx_data(data))
+    assert idx.meta['delete_count'] != '0'
+    assert idx.fuzzy_words("argentia") == ["argentina"]
+    assert idx.fuzzy_words("argentinos") == ["argentino", "argentinas", "argentina"]
+    assert idx.fuzzy_words("argnetina") == ["argentina"]
+    assert idx.fuzzy_words("arrgentinna") == ["argentina"]
+    assert idx.fuzzy_words("histria") == ["historia"]
+    # short words are corrected only by one edit, and the shortest ones not at all
+    assert idx.fuzzy_words("cosa") == ["casa", "cosas"]
+    assert idx.fuzzy_words("caa") == ["casa"]
+    assert idx.fuzzy_words("ca") == []
+    assert idx.fuzzy_words("zzzzzz") == []
+
+
+def test_search_corrects_keys(create_index):
+    """When nothing is found, the keys that are not in any word are corrected."""
+    data = ["historia argentina", "historia universal", "argentinos"]
+    idx = create_index(to_idx_data(data))
+    assert list(idx.search(["argentia"])) == [get_ie("historia argentina")]
+    assert list(idx.search(["histori", "argentia"])) == [get_ie("historia argentina")]
+    # keys found in some word are kept as they are
+    assert list(idx.search(["universal", "argentin"])) == []
+    assert list(idx.search(["zzzzzz"])) == []
+
+
+def test_search_corrects_keys_without_searching_them(create_index, mocker):
+    """The keys without words are found fetching them, not searching each one."""
+    data = ["historia argentina", "historia universal", "argentinos"]
+    idx = create_index(to_idx_data(data))
+    search_keys = mocker.spy(idx, '_search_keys')
+    assert list(idx.search(["universal", "argentia"])) == []
+    # the keys, and the corrected ones
+    assert [call[0][0] for call in search_keys.call_args_list] == [
+        ("universal", "argentia"), ("universal", "argentina")]
+
+
+def test_fuzzy_old_index(create_index):
+    """Indexes without the deletes of the words are searched, without corrections."""
+    idx = create_index(to_idx_data(["historia argentina"]))
+    with open_writable(idx) as db:
+        db.execute("DROP TABLE deletes")
+    idx = sqlite_index.Index(idx._directory)
+    assert not idx.use_deletes
+    assert idx.fuzzy_words("argentia") == []
+    assert list(idx.search(["argentia"])) == []
+
+
+@pytest.mark.parametrize('keys', [[], [" "], ["", "  "]])
+def test_search_without_words(create_index, keys):
+    """Nothing is found without words."""
+    idx = create_index(to_idx_data(["ala blanca"]))
+    results = idx.search(keys)
+    assert list(results) == []
+    assert results.total == 0
+    assert len(idx.cache) == 0
+
+
+def test_search_cached_normalized(create_index):
+    """The same words in any case, accents or spacing hit the same cached search."""
+    idx = create_index(to_idx_data(["historia argentina", "argentina", "historia"]))
+    expected = list(idx.search(["argentina"]))
+    assert idx.cache.stats()['misses'] == 1
+    for keys in (["Argentina"], ["argentina "], ["ARGENTINA"], ["Argéntina"]):
+        assert list(idx.search(keys)) == expected
+    assert idx.cache.stats()['hits'] == 4
+    assert idx.cache.stats()['entries'] == 1
+
+    # the keys are kept in their order
+    assert list(idx.search(["argentina historia"])) == list(idx.search(["argentina", "historia"]))
+    assert idx.cache.stats()['entries'] == 2
+
+
+def test_search_cached_corrected(create_index):
+    """The results of the corrected keys are cached for the misspelled ones."""
+    idx = create_index(to_idx_data(["historia argentina", "historia universal"]))
+    assert list(idx.search(["argentia"])) == [get_ie("historia argentina")]
+    assert list(idx.search(["argentia"])) == [get_ie("historia argentina")]
+    assert idx.cache.stats()['hits'] == 1
+
+
+def test_search_pages(create_index, mocker):
+    """The results are got by pages, ranking and caching all of them once."""
+    data = ["blanca {}".format(i) for i in range(30)]
+    idx = create_index(to_idx_data(data))
+    expected = list(idx.search(["blanca"]))
+    assert len(expected) == 30
+
+    idx = sqlite_index.Index(idx._directory)
+    results = idx.search(["blanca"], offset=0, limit=10)
+    assert list(results) == expected[:10]
+    assert results.total == 30
+    assert len(idx.cache) == 1
+    search_mock = mocker.patch.object(sqlite_index, 'Search')
+    assert list(idx.search(["Blanca"], offset=10, limit=10)) == expected[10:20]
+    assert list(idx.search(["blanca"], offset=25, limit=10)) == expected[25:]
+    assert list(idx.search(["blanca"], offset=40, limit=10)) == []
+    search_mock.assert_not_called()
+
+
+def test_search_pages_get_only_page(create_index, mocker):
+    """Only the docs of the requested page are got."""
+    data = ["blanca {}".format(i) for i in range(30)]
+    idx = create_index(to_idx_data(data))
+    get_doc = mocker.spy(idx, 'get_doc')
+    assert len(list(idx.search(["blanca"], offset=5, limit=10))) == 10
+    assert get_doc.call_count == 10
+
+
+def test_search_redirects_once(create_index):
+    """The article and its redirects are returned only once, in the best position."""
+    data = to_idx_data(["aaa", "abc"])
+    data[0][-1] = {("abc", "zzz")}
+    idx = create_index(data)
+    results = idx.search(["abc"])
+    assert [entry.link for entry in results] == ["aaa", "abc"]
+    assert results.total == 2
+
+
+def test_query_cache_size():
+    """The least recently used searches are evicted to keep the cache in its size."""
+    cache = sqlite_index.QueryCache(size=2000)
+    for i in range(20):
+        cache.put(("word{}".format(i),), range(100))
+    stats = cache.stats()
+    assert 0 < stats['bytes'] <= 2000
+    assert stats['entries'] + stats['evictions'] == 20
+    assert cache.get(("word0",)) is None
+    docids, truncated = cache.get(("word19",))
+    assert list(docids) == list(range(100))
+    assert not truncated
+
+    # used keys are kept over the older ones
+    oldest = next(iter(cache._entries))
+    cache.get(oldest)
+    cache.put(("new",), range(100))
+    assert cache.get(oldest) is not None
+
+    # bigger results than the whole cache are not kept
+    cache.put(("huge",), range(1000))
+    assert cache.get(("huge",)) is None
+    assert cache.stats()['bytes'] <= 2000
+
+
+def test_query_cache_disabled(create_index):
+    """With no size, nothing is cached."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco"]))
+    idx = sqlite_index.Index(idx._directory, cache_size=0)
+    assert list(idx.search(["blanc"])) == list(idx.search(["blanc"]))
+    assert idx.cache.stats() == {
+        'hits': 0, 'misses': 2, 'evictions': 0, 'entries': 0, 'bytes': 0}
+
+
+def test_search_exact_match_bonus(create_index):
+    """The phrase equal to the keys gets the bonus, whatever the keys sequence type."""
+    idx = create_index(to_idx_data(["ala blanca", "ala blanca grande"]))
+    for keys in (["ala", "blanca"], ("ala", "blanca")):
+        search = sqlite_index.Search(idx.db, keys, use_tokenids=True)
+        bonus = sqlite_index.Search.EXACT_MATCH_BONUS
+        assert search.iterative_levenshtein(["ala", "blanca"]) == -bonus
+        assert search.iterative_levenshtein(["ala", "blanca", "grande"]) > -bonus
+
+
+def test_search_max_scored(create_index):
+    """The search scoring too many docs is truncated, returning the best ones scored."""
+    data = ["blanca {}".format(i) for i in range(100)]
+    idx = create_index(to_idx_data(data))
+    expected = list(idx.search(["blanca"]))
+    idx = sqlite_index.Index(idx._directory, search_max_scored=10)
+    results = idx.search(["blanca"])
+    truncated = list(results)
+    assert results.truncated
+    assert len(truncated) == 10
+    assert set(truncated) < set(expected)
+    # they are cached as truncated, and counted
+    assert len(idx.cache) == 1
+    assert idx.search_stats()['truncated'] == 1
+
+    results = idx.search(["blanca", "99"])
+    assert list(results) == [get_ie("blanca 99")]
+    assert not results.truncated
+
+
+def test_search_truncated_pages(create_index, mocker):
+    """The pages of a truncated search are got from its first ranking."""
+    data = ["blanca {}".format(i) for i in range(100)]
+    idx = create_index(to_idx_data(data))
+    idx = sqlite_index.Index(idx._directory, search_max_scored=30)
+    rank = mocker.spy(idx, '_rank')
+    found = []
+    for offset in range(0, 40, 10):
+        results = idx.search(["blanca"], offset=offset, limit=10)
+        assert results.truncated
+        assert results.total == 30
+        found.extend(results)
+    assert rank.call_count == 1
+    assert len(found) == len(set(found)) == 30
+    assert found == list(idx.search(["blanca"]))
+
+
+def test_search_timeout(create_index):
+    """The search is truncated when its time is over, without correcting the keys."""
+    idx = create_index(to_idx_data(["historia argentina", "historia universal"]))
+    idx = sqlite_index.Index(idx._directory, search_timeout=0)
+    for keys in (["historia"], ["argentia"]):
+        results = idx.search(keys)
+        assert list(results) == []
+        assert results.truncated
+    assert idx.search_stats()['truncated'] == 2
+    # nothing was found just because the time was over, so they are not cached
+    assert len(idx.cache) == 0
+
+
+def test_search_timeout_interrupts_queries(create_index, monkeypatch):
+    """The queries of the search are interrupted when its time is over."""
+    monkeypatch.setattr(sqlite_index, 'PROGRESS_STEPS', 1)
+    data = ["blanca {}".format(i) for i in range(100)]
+    idx = create_index(to_idx_data(data))
+    for use_ngrams in (False, True):
+        search = sqlite_index.Search(idx.db, ["blanca"], use_ngrams=use_ngrams,
+                                     use_tokenids=True, deadline=time.monotonic() - 1)
+        assert search.truncated
+        assert search.results == []
+
+        # the connections are still usable, without the deadline
+        search = sqlite_index.Search(idx.db, ["blanca"], use_ngrams=use_ngrams,
+                                     use_tokenids=True)
+        assert not search.truncated
+        assert len(search.results) == 100
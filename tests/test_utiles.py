@@ -0,0 +1,50 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+
+"""Tests for the 'utiles' module."""
+
+from src.utiles import SizedLRUCache
+
+
+def test_sized_lru_cache_size():
+    """The least recently used entries are evicted to keep the cache in its size."""
+    cache = SizedLRUCache(size=5000)
+    for i in range(20):
+        cache.put('Artículo_{}'.format(i), b'x' * 1000)
+    stats = cache.stats()
+    assert 0 < stats['bytes'] <= 5000
+    assert stats['entries'] + stats['evictions'] == 20
+    assert cache.get('Artículo_0') is None
+    assert cache.get('Artículo_19') == b'x' * 1000
+
+    # used entries are kept over the older ones
+    oldest = next(iter(cache._entries))
+    cache.get(oldest)
+    cache.put('Nuevo', b'x' * 1000)
+    assert cache.get(oldest) is not None
+
+    # bigger entries than the whole cache are not kept
+    cache.put('Enorme', b'x' * 10000)
+    assert cache.get('Enorme') is None
+    assert cache.stats()['bytes'] <= 5000
+
+
+def test_sized_lru_cache_disabled():
+    """With no size, nothing is cached."""
+    cache = SizedLRUCache(size=0)
+    cache.put('Artículo', b'x')
+    assert cache.get('Artículo') is None
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'evictions': 0, 'entries': 0, 'bytes': 0}
@@ -17,6 +17,7 @@
 # For further info, check  https://github.com/PyAr/CDPedia/
 
 
+import json
 import os
 import tarfile
 from unittest.mock import patch
@@ -26,9 +27,10 @@ from werkzeug.wrappers import Response
 
 import config
 from src.armado import cdpindex
-from src.armado.sqlite_index import IndexEntry
+from src.armado.sqlite_index import IndexEntry, SearchResults
 from src.web import web_app, utils
 from src.web.test_infra import TEST_INFRA_FILENAME
+from tests.utils import load_run_config
 
 import pytest
 
@@ -74,6 +76,24 @@ def create_app_client(mocker, tmp_path):
     return lambda: (app, client)
 
 
+def test_app_with_run_config(create_app_client, mocker, tmp_path):
+    """The app starts with the config generated for the final user computer."""
+    cdbase = tmp_path / 'cdbase'
+    cdbase.mkdir()
+    run_config = load_run_config(mocker, cdbase)
+    # the directories are relative to the disc, use the ones of the test
+    run_config.DIR_ASSETS = config.DIR_ASSETS
+    run_config.DIR_INDICE = config.DIR_INDICE
+    mocker.patch('src.web.web_app.config', run_config)
+    mocker.patch('src.armado.cdpindex.config', run_config)
+
+    app, client = create_app_client()
+    assert app.art_mngr.cache.size == run_config.ARTICLES_CACHE_SIZE
+    response = client.get("/search/key1")
+    assert response.status_code == 200
+    assert b'Page1' in response.data
+
+
 def test_main_page_portal(create_app_client):
     app, client = create_app_client()
 
@@ -105,6 +125,49 @@ def test_images_not_found(create_app_client):
     assert response.status_code == 500
 
 
+def test_images_ok(create_app_client):
+    app, client = create_app_client()
+    app.img_mngr.get_item_view = lambda name: memoryview(b'0123456789')
+    response = client.get("/images/an/image/img.png")
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+    assert response.headers["Content-type"] == "image/png"
+    assert response.headers["Content-Length"] == "10"
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+
+@pytest.mark.parametrize('range_, expected, content_range', [
+    ('bytes=2-5', b'2345', 'bytes 2-5/10'),
+    ('bytes=7-', b'789', 'bytes 7-9/10'),
+    ('bytes=-4', b'6789', 'bytes 6-9/10'),
+    ('bytes=8-20', b'89', 'bytes 8-9/10'),
+])
+def test_images_range(create_app_client, range_, expected, content_range):
+    app, client = create_app_client()
+    app.img_mngr.get_item_view = lambda name: memoryview(b'0123456789')
+    response = client.get("/images/an/image/img.png", headers={'Range': range_})
+    assert response.status_code == 206
+    assert response.data == expected
+    assert response.headers["Content-Range"] == content_range
+    assert response.headers["Content-Length"] == str(len(expected))
+
+
+def test_images_range_not_satisfiable(create_app_client):
+    app, client = create_app_client()
+    app.img_mngr.get_item_view = lambda name: memoryview(b'0123456789')
+    response = client.get("/images/an/image/img.png", headers={'Range': 'bytes=20-30'})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+
+
+def test_images_several_ranges(create_app_client):
+    app, client = create_app_client()
+    app.img_mngr.get_item_view = lambda name: memoryview(b'0123456789')
+    response = client.get("/images/an/image/img.png", headers={'Range': 'bytes=0-1,5-6'})
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+
+
 def test_wiki_article_not_found(create_app_client):
     _, client = create_app_client()
     response = client.get("/wiki/this_article_does_not_exists")
@@ -190,13 +253,77 @@ def test_search_endpoint_ok(create_app_client):
             IndexEntry(
                 IndexEntry.TYPE_ORIG_ARTICLE,
                 link='t/e/s/testlink', title='testtitle', description='testtext'),
-        ]
+        ], 1, False
         response = client.post("/search", data={"keywords": "foo bar"})
     assert response.status_code == 200
-    mock.assert_called_once_with('foo bar')
+    mock.assert_called_once_with('foo bar', 0, config.SEARCH_RESULTS)
     assert b'testlink' in response.data
     assert b'testtitle' in response.data
     assert b'testtext' in response.data
+    assert b'search-truncated' not in response.data
+
+
+def test_search_endpoint_truncated(create_app_client):
+    _, client = create_app_client()
+    with patch.object(web_app.CDPedia, '_search') as mock:
+        mock.return_value = [
+            IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink', title='testtitle'),
+        ], 1, True
+        response = client.post("/search", data={"keywords": "a"})
+    assert response.status_code == 200
+    assert b'testtitle' in response.data
+    assert b'search-truncated' in response.data
+
+
+def test_search_results_pages(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/search/key?offset=0&limit=1")
+    assert response.status_code == 200
+    assert b'Page2' in response.data
+    assert b'Page1' not in response.data
+    assert b'/search/key?offset=1&amp;limit=1' in response.data
+
+    response = client.get("/search/key?offset=1&limit=1")
+    assert b'Page1' in response.data
+    assert b'Page2' not in response.data
+    assert b'/search/key?offset=0&amp;limit=1' in response.data
+
+    # all the results in a page, without paging
+    response = client.get("/search/key")
+    assert b'Page1' in response.data
+    assert b'Page2' in response.data
+    assert b'paging-results' not in response.data
+
+
+def test_search_results_past_the_end(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/search/key?offset=10&limit=1")
+    assert response.status_code == 200
+    assert b'paging-results' in response.data
+    assert b'/search/key?offset=1&amp;limit=1' in response.data
+    assert 'Resultados de buscar'.encode('utf8') in response.data
+
+
+def test_search_results_blank_key(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/search/%20")
+    assert response.status_code == 200
+    assert b'search-result' not in response.data
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("", (0, config.SEARCH_RESULTS)),
+    ("?offset=40&limit=10", (40, 10)),
+    ("?offset=-5&limit=0", (0, 1)),
+    ("?offset=foo&limit=100000", (0, web_app.SEARCH_MAX_RESULTS)),
+])
+def test_search_results_args(create_app_client, query, expected):
+    _, client = create_app_client()
+    with patch.object(web_app.CDPedia, '_search') as mock:
+        mock.return_value = [], 0, False
+        response = client.get("/search/foo%2Fbar moño" + query)
+    assert response.status_code == 200
+    mock.assert_called_once_with('foo/bar moño', *expected)
 
 
 def test_search_endpoint_empty(create_app_client):
@@ -210,16 +337,19 @@ def test_search_real_search(create_app_client):
     app = web_app.create_app(watchdog=None, with_static=False)
 
     with patch.object(app.index, 'search') as index_mock:
-        index_mock.return_value = [
+        index_mock.return_value = SearchResults([
             IndexEntry(
                 IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink1',
                 title='testtitle1', score=123, description='testtext1'),
             IndexEntry(
                 IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink moño',
                 title='testtitle2', score=456, description='testtext2'),
-        ]
-        results = app._search("foo bar Moño")
-    index_mock.assert_called_once_with(['foo', 'bar', 'mono'])
+        ])
+        results, total, truncated = app._search("foo bar Moño")
+    index_mock.assert_called_once_with(
+        ['foo', 'bar', 'mono'], offset=0, limit=config.SEARCH_RESULTS)
+    assert total == 2
+    assert not truncated
 
     result1, result2 = results
     assert result1.link == 'wiki/testlink1'
@@ -230,18 +360,74 @@ def test_search_real_search(create_app_client):
     assert result2.description == 'testtext2'
 
 
+def test_search_keeps_index_entries(create_app_client):
+    """The links are computed in copies of the entries, that the index may keep."""
+    app = web_app.create_app(watchdog=None, with_static=False)
+    entry = IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink', title='testtitle')
+
+    with patch.object(app.index, 'search') as index_mock:
+        index_mock.return_value = SearchResults([entry])
+        results, _, _ = app._search("foo")
+        index_mock.return_value = SearchResults([entry])
+        results_again, _, _ = app._search("foo")
+    assert results[0].link == results_again[0].link == 'wiki/testlink'
+    assert entry.link == 't/e/s/testlink'
+
+
 def test_search_term_with_slash(create_app_client):
     app = web_app.create_app(watchdog=None, with_static=False)
 
     with patch.object(app.index, 'search') as index_mock:
-        index_mock.return_value = [
+        index_mock.return_value = SearchResults([
             IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='f/o/o/foo/bar', title='testtitle')
-        ]
-        results = app._search("foo/bar")
-    index_mock.assert_called_once_with(['foo/bar'])
+        ])
+        results, _, _ = app._search("foo/bar")
+    index_mock.assert_called_once_with(['foo/bar'], offset=0, limit=config.SEARCH_RESULTS)
     assert results[0].link == 'wiki/foo%2Fbar'
 
 
+def test_autocomplete_endpoint(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/autocomplete?q=Ke")
+    assert response.status_code == 200
+    assert response.headers["Content-type"] == "application/json"
+    assert json.loads(response.data.decode("utf-8")) == [
+        {"title": "Page2", "link": "wiki/page2"},
+        {"title": "Page1", "link": "wiki/page1"},
+    ]
+
+    response = client.get("/autocomplete?q=foo")
+    assert json.loads(response.data.decode("utf-8")) == []
+
+
+def test_autocomplete_real_search(create_app_client):
+    app = web_app.create_app(watchdog=None, with_static=False)
+
+    with patch.object(app.index, 'search_prefix') as index_mock:
+        index_mock.return_value = [
+            IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/test moño', title='Test moño')]
+        results = app._autocomplete("foo Mo")
+    index_mock.assert_called_once_with(['foo', 'mo'], web_app.AUTOCOMPLETE_RESULTS)
+    assert json.loads(results) == [{"title": "Test moño", "link": "wiki/test%20mo%C3%B1o"}]
+
+
+def test_autocomplete_cached_normalized(create_app_client):
+    app = web_app.create_app(watchdog=None, with_static=False)
+
+    with patch.object(app.index, 'search_prefix') as index_mock:
+        index_mock.return_value = []
+        for search_string in ("foo Mo", "Foo  mo", "FOO MÓ"):
+            app._autocomplete(search_string)
+    index_mock.assert_called_once_with(['foo', 'mo'], web_app.AUTOCOMPLETE_RESULTS)
+
+
+def test_autocomplete_last_char(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/autocomplete?q=%F4%8F%BF%BF")
+    assert response.status_code == 200
+    assert json.loads(response.data.decode("utf-8")) == []
+
+
 def test_on_tutorial(create_app_client):
     _, client = create_app_client()
     response = client.get("/tutorial")
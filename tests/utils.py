@@ -16,9 +16,12 @@
 
 import codecs
 import os
+import types
 
 import bs4
 
+from src import generate
+
 
 class FakeWikiFile:
     """Emulate a simplified WikiFile object."""
@@ -47,3 +50,16 @@ def load_test_article(name):
     html = load_fixture(name)
     wikifile = FakeWikiFile(html)
     return html, wikifile
+
+
+def load_run_config(mocker, directory):
+    """Generate the config used on the final user computer, returning it as a module."""
+    mocker.patch('config.DIR_CDBASE', str(directory))
+    mocker.patch.dict('os.environ', {'LANGUAGE': 'es'})
+    generate.gen_run_config({'portal_index': 'Portal:Portal'})
+
+    run_config = types.ModuleType('config')
+    with open(os.path.join(str(directory), 'config.py'), 'rt', encoding='utf8') as fh:
+        code = fh.read()
+    exec(compile(code, 'config.py', 'exec'), run_config.__dict__)
+    return run_config
@@ -0,0 +1,144 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+"""Benchmark the latency of getting articles from a block, by their position in it.
+
+The articles of an existing block (or random ones, if none is given) are compressed again
+everything together, as the older blocks, and in frames of several sizes, reporting the
+block size and the latency of getting the articles in each fifth of the block.
+"""
+
+import argparse
+import lzma
+import os
+import pickle
+import random
+import struct
+import sys
+import tempfile
+import timeit
+sys.path.append(os.path.abspath(os.curdir))
+
+import config  # NOQA import after fixing path
+from src.armado.compresor import Comprimido  # NOQA import after fixing path
+
+PARTS = 5
+
+
+def get_articles(fname):
+    """Get the articles of the block, in their order."""
+    block = Comprimido(fname)
+    names = [name for name, info in block.header.items() if not isinstance(info, str)]
+    names.sort(key=lambda name: block.header[name][0])
+    return [(name, block.get_item(name)) for name in names]
+
+
+def random_articles(quantity):
+    """Build articles of random words, with sizes like the real ones."""
+    words = ["".join(random.choice("abcdefghijlmnoprstuv") for _ in range(random.randint(2, 10)))
+             for _ in range(5000)]
+    articles = []
+    for i in range(quantity):
+        size = int(random.lognormvariate(9.5, 0.8))
+        paragraphs = []
+        while sum(map(len, paragraphs)) < size:
+            paragraphs.append("<p>{}</p>\n".format(" ".join(random.sample(words, 50))))
+        articles.append(("Article_{}".format(i), "".join(paragraphs).encode("utf8")))
+    return articles
+
+
+def write_single_block(fname, articles):
+    """Write the block with everything compressed together, as the older blocks."""
+    header = {}
+    seek = 0
+    for name, data in articles:
+        header[name] = (seek, len(data))
+        seek += len(data)
+    header_bytes = pickle.dumps(header)
+    with lzma.LZMAFile(fname, "wb") as fh:
+        fh.write(struct.pack("<l", len(header_bytes)))
+        fh.write(header_bytes)
+        for _, data in articles:
+            fh.write(data)
+
+
+def write_framed_block(directory, articles, frame_size):
+    """Write the block in frames, through the articles files."""
+    config.DIR_PAGSLISTAS = os.path.join(directory, "paglistas")
+    config.DIR_PAGES_BLOCKS = directory
+    config.ARTICLES_FRAME_SIZE = frame_size
+    os.makedirs(os.path.join(config.DIR_PAGSLISTAS, "x"), exist_ok=True)
+    for name, data in articles:
+        with open(os.path.join(config.DIR_PAGSLISTAS, "x", name), "wb") as fh:
+            fh.write(data)
+    Comprimido.crear([], 0, [("x", name) for name, _ in articles])
+    return os.path.join(directory, "00000000.cdp")
+
+
+def bench(name, fname, articles, quantity):
+    """Get random articles of the block, and show the average latency by position."""
+    block = Comprimido(fname)
+    latencies = [[] for _ in range(PARTS)]
+    for _ in range(quantity):
+        position = random.randrange(len(articles))
+        article_name, data = articles[position]
+        initial_time = timeit.default_timer()
+        item = block.get_item(article_name)
+        latency = timeit.default_timer() - initial_time
+        latencies[position * PARTS // len(articles)].append(latency)
+        if item != data:
+            print("ERROR: different article got from the block!")
+    block.fh.close()
+
+    averages = ["{:10.2f}".format(sum(part) * 1000 / len(part)) for part in latencies if part]
+    print("{:>14} {:10.2f} {}".format(
+        name, os.path.getsize(fname) / 1024 ** 2, " ".join(averages)))
+
+
+if __name__ == "__main__":
+    help = """Benchmark the latency of getting articles from a block, by their position."""
+
+    parser = argparse.ArgumentParser(description=help)
+    parser.add_argument('-b', '--block', dest='block',
+                        help="Block of articles (.cdp) to use; random articles if not given")
+    parser.add_argument('-a', '--articles', dest='articles', type=int,
+                        default=config.ARTICLES_PER_BLOCK,
+                        help="Quantity of random articles (default: %(default)s)")
+    parser.add_argument('-f', '--frame-sizes', dest='frame_sizes', type=int, nargs='+',
+                        default=[16384, 65536, 131072, 524288],
+                        help="Sizes of the frames to compare (in bytes)")
+    parser.add_argument('-q', '--quantity', dest='quantity', type=int,
+                        default=200, help="Quantity of articles to get from each block")
+    parser.add_argument('-s', '--seed', dest='seed', type=int,
+                        default=0, help="Seed for the random articles")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.block:
+        articles = get_articles(args.block)
+    else:
+        articles = random_articles(args.articles)
+    print("Block of {} articles, {:.1f} MB uncompressed".format(
+        len(articles), sum(len(data) for _, data in articles) / 1024 ** 2))
+    print("{:>14} {:>10} {}".format("frame", "size (MB)", " ".join(
+        "{:>10}".format("{}% (ms)".format((part + 1) * 100 // PARTS)) for part in range(PARTS))))
+    with tempfile.TemporaryDirectory() as directory:
+        fname = os.path.join(directory, "single.cdp")
+        write_single_block(fname, articles)
+        bench("everything", fname, articles, args.quantity)
+    for frame_size in args.frame_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            fname = write_framed_block(directory, articles, frame_size)
+            bench("{} KB".format(frame_size // 1024), fname, articles, args.quantity)
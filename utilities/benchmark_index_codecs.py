@@ -0,0 +1,120 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+"""Benchmark the codecs and page sizes of the index docs.
+
+The documents of an existing index (by default, in ./idx path) are indexed again with
+every codec and page size, reporting the index size, the build time and the latency of
+getting docs whose page is not cached.
+"""
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import timeit
+from collections import defaultdict
+from unittest.mock import MagicMock
+sys.path.append(os.path.abspath(os.curdir))
+
+from src.armado.cdpindex import tokenize  # NOQA import after fixing path
+from src.armado.sqlite_index import CODECS, Index, IndexEntry, to_filename  # NOQA
+import src.armado.to3dirs    # NOQA import after fixing path
+
+mock = MagicMock()
+mock.__contains__ = MagicMock(return_value=True)
+src.armado.to3dirs.namespaces = mock
+
+
+def get_source(idx):
+    """Rebuild the source of the index, from its stored documents."""
+    redirects = defaultdict(set)
+    articles = []
+    for docid, entry in enumerate(idx.values()):
+        if entry.rtype == IndexEntry.TYPE_REDIRECT:
+            redirects[entry.orig_docid].add(tuple(entry.subtitle.split()))
+        else:
+            articles.append((docid, entry))
+
+    source = []
+    for docid, entry in articles:
+        link = entry.link
+        if entry.rtype == IndexEntry.TYPE_ORIG_SIMPLE_LINK:
+            link = to_filename(entry.title)
+        source.append((entry.title, link, entry.score, entry.description,
+                       tuple(tokenize(entry.title)), redirects[docid]))
+    return source
+
+
+def percentile(values, percent):
+    """Return the percentile of the sorted values."""
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+def bench(source, codec, page_size, quantity):
+    """Build the index with the codec and page size, and measure it."""
+    with tempfile.TemporaryDirectory() as directory:
+        initial_time = timeit.default_timer()
+        Index.create(directory, source, codec=codec, page_size=page_size)
+        build_time = timeit.default_timer() - initial_time
+        size = os.path.getsize(os.path.join(directory, "index.sqlite"))
+
+        idx = Index(directory)
+        latencies = []
+        for _ in range(quantity):
+            docid = random.randrange(len(idx))
+            idx._load_page.cache_clear()
+            initial_time = timeit.default_timer()
+            idx.get_doc(docid)
+            latencies.append(timeit.default_timer() - initial_time)
+        idx.db.close()
+
+    latencies.sort()
+    print("{:>14} {:>6} {:12.1f} {:10.1f} {:12.3f} {:12.3f}".format(
+        codec, page_size, size / 1024 ** 2, build_time,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+if __name__ == "__main__":
+    help = """Benchmark the codecs and page sizes of the index docs.
+
+    Uses ./idx as default path to index."""
+
+    parser = argparse.ArgumentParser(description=help)
+    parser.add_argument('-p', '--path', dest='path',
+                        default="./idx", help="Index's db path")
+    parser.add_argument('-c', '--codecs', dest='codecs', nargs='+',
+                        choices=sorted(CODECS), default=sorted(CODECS),
+                        help="Codecs to compare: %(choices)s (default: all)")
+    parser.add_argument('-z', '--page-sizes', dest='page_sizes', type=int, nargs='+',
+                        default=[128, 512, 2048], help="Page sizes to compare")
+    parser.add_argument('-q', '--quantity', dest='quantity', type=int,
+                        default=1000, help="Quantity of docs to get from each index")
+    parser.add_argument('-s', '--seed', dest='seed', type=int,
+                        default=0, help="Seed for the random docs")
+    args = parser.parse_args()
+
+    # the index creation is too verbose
+    logging.disable(logging.INFO)
+    random.seed(args.seed)
+    source = get_source(Index(args.path))
+    print("Indexing {} articles".format(len(source)))
+    print("{:>14} {:>6} {:>12} {:>10} {:>12} {:>12}".format(
+        "codec", "page", "size (MB)", "build (s)", "p50 (ms)", "p99 (ms)"))
+    for codec in args.codecs:
+        for page_size in args.page_sizes:
+            bench(source, codec, page_size, args.quantity)
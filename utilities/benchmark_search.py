@@ -0,0 +1,271 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+"""Benchmark the search in an existing index.
+
+By default, it uses ./idx path.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from unittest.mock import MagicMock
+sys.path.append(os.path.abspath(os.curdir))
+
+from src.armado.sqlite_index import DocSet, Index, QueryCache, Search  # NOQA import after fixing path
+import src.armado.to3dirs    # NOQA import after fixing path
+
+mock = MagicMock()
+mock.__contains__ = MagicMock(return_value=True)
+src.armado.to3dirs.namespaces = mock
+
+
+def get_queries(words, quantity):
+    """Build the different groups of queries to benchmark, from random words."""
+    def partial():
+        word = random.choice(words)
+        start = random.randint(0, len(word) // 2)
+        end = len(word) - random.randint(0, len(word) // 2)
+        return word[start:end] or word
+
+    return [
+        ("Complete words", [[random.choice(words)] for _ in range(quantity)]),
+        ("Complete words, three by three",
+         [[random.choice(words) for _ in range(3)] for _ in range(quantity)]),
+        ("Partial words", [[partial()] for _ in range(quantity)]),
+        ("Partial words, three by three",
+         [[partial() for _ in range(3)] for _ in range(quantity)]),
+        ("Short keys", [[random.choice(words)[:2]] for _ in range(quantity)]),
+    ]
+
+
+def run_search(idx, keys, use_ngrams):
+    """Do the search and return the ordered docids."""
+    search = Search(idx.db, keys, use_ngrams=use_ngrams, use_docfreq=idx.use_docfreq,
+                    use_tokenids=idx.use_tokenids, page_size=idx.page_size)
+    return list(search.ordered())
+
+
+def bench_ngrams(idx, queries):
+    """Compare the n-grams search against the full scan of the tokens table."""
+    if not idx.use_ngrams:
+        print("The index has no n-grams table, only the full scan can be measured.")
+        return
+
+    print("{:>35} {:>12} {:>12} {:>8}".format("", "LIKE (ms)", "n-grams (ms)", "speedup"))
+    for name, group in queries:
+        times = {}
+        results = {}
+        for use_ngrams in (False, True):
+            initial_time = timeit.default_timer()
+            results[use_ngrams] = [run_search(idx, keys, use_ngrams) for keys in group]
+            times[use_ngrams] = (timeit.default_timer() - initial_time) * 1000 / len(group)
+        if results[False] != results[True]:
+            print("ERROR: different results with the n-grams search!")
+        print("{:>35} {:12.2f} {:12.2f} {:7.1f}x".format(
+            name, times[False], times[True], times[False] / times[True]))
+
+
+def bench_memory(idx, queries):
+    """Measure the time and the peak of memory allocated by each complete search."""
+    print("{:>35} {:>12} {:>16} {:>16}".format(
+        "", "time (ms)", "avg peak (KB)", "max peak (KB)"))
+    for name, group in queries:
+        peaks = []
+        total_time = 0
+        for keys in group:
+            tracemalloc.start()
+            initial_time = timeit.default_timer()
+            list(idx.search(keys))
+            total_time += timeit.default_timer() - initial_time
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        print("{:>35} {:12.2f} {:16.1f} {:16.1f}".format(
+            name, total_time * 1000 / len(group),
+            sum(peaks) / len(peaks) / 1024, max(peaks) / 1024))
+
+
+def bench_skips(idx, queries):
+    """Compare the AND of the biggest docsets against fewer docids, by their size ratio.
+
+    The candidates are probed jumping with the docset skips, or decoding it entirely.
+    """
+    cur = idx.db.execute("SELECT docsets FROM tokens ORDER BY length(docsets) DESC LIMIT 10")
+    docsets = [row[0] for row in cur.fetchall() if DocSet.has_skips(row[0])]
+    if not docsets:
+        print("The index has no docsets with skips, nothing to measure.")
+        return
+
+    print("{:>35} {:>12} {:>12} {:>8}".format("", "decode (ms)", "skips (ms)", "speedup"))
+    for ratio in (2, 8, 32, 128, 512, 2048):
+        times = {False: 0, True: 0}
+        for encoded in docsets:
+            docids = DocSet.decode_docids(encoded)
+            candidates = sorted(random.sample(range(docids[-1] + 1), max(
+                1, len(docids) // ratio)))
+            initial_time = timeit.default_timer()
+            by_decoding = sorted(set(candidates).intersection(DocSet.decode_docids(encoded)))
+            times[False] += timeit.default_timer() - initial_time
+            initial_time = timeit.default_timer()
+            by_skips = DocSet.probe(encoded, candidates)
+            times[True] += timeit.default_timer() - initial_time
+            if by_decoding != by_skips:
+                print("ERROR: different results probing with the skips!")
+        print("{:>35} {:12.3f} {:12.3f} {:7.1f}x".format(
+            "Size ratio 1:{}".format(ratio), times[False] * 1000 / len(docsets),
+            times[True] * 1000 / len(docsets), times[False] / times[True]))
+
+
+def bench_threads(idx, queries):
+    """Measure the searches per second of all the queries, done from several threads."""
+    all_keys = [keys for name, group in queries for keys in group]
+    print("{:>35} {:>12} {:>10}".format("", "searches/s", "scaling"))
+    base = None
+    for threads in (1, 2, 4, 8):
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            initial_time = timeit.default_timer()
+            list(executor.map(lambda keys: list(idx.search(keys)), all_keys))
+            throughput = len(all_keys) / (timeit.default_timer() - initial_time)
+        base = base or throughput
+        print("{:>35} {:12.1f} {:9.2f}x".format(
+            "{} threads".format(threads), throughput, throughput / base))
+
+
+def bench_lookups(idx, queries):
+    """Measure the exact lookup of existing and missing words."""
+    words = [keys[0] for name, group in queries if name == "Complete words" for keys in group]
+    print("{:>35} {:>12}".format("", "lookup (us)"))
+    for name, keys in (("Existing words", words), ("Missing words", [w + "#" for w in words])):
+        initial_time = timeit.default_timer()
+        for _ in range(100):
+            for key in keys:
+                key in idx
+        print("{:>35} {:12.2f}".format(
+            name, (timeit.default_timer() - initial_time) * 10 ** 6 / 100 / len(keys)))
+
+
+def misspell(word, edits):
+    """Apply some random edits to the word: delete, insert or replace a char."""
+    for _ in range(edits):
+        i = random.randrange(len(word))
+        edit = random.choice(("delete", "insert", "replace"))
+        if edit == "delete" and len(word) > 1:
+            word = word[:i] + word[i + 1:]
+        elif edit == "insert":
+            word = word[:i] + random.choice(word) + word[i:]
+        else:
+            word = word[:i] + random.choice(word) + word[i + 1:]
+    return word
+
+
+def bench_fuzzy(idx, queries):
+    """Measure the correction of misspelled words, and how many are corrected."""
+    if not idx.use_deletes:
+        print("The index has no deletes of the words, nothing to measure.")
+        return
+
+    words = [keys[0] for name, group in queries if name == "Complete words" for keys in group]
+    words = [word for word in words if len(word) >= 5 and not word.isdigit()]
+    if not words:
+        print("The index has no words long enough to misspell, nothing to measure.")
+        return
+    print("{:>35} {:>12} {:>12} {:>10}".format("", "avg (ms)", "max (ms)", "corrected"))
+    for edits in (1, 2):
+        times = []
+        corrected = 0
+        for word in words:
+            key = misspell(word, edits)
+            initial_time = timeit.default_timer()
+            candidates = idx.fuzzy_words(key)
+            times.append(timeit.default_timer() - initial_time)
+            corrected += key == word or word in candidates
+        print("{:>35} {:12.3f} {:12.3f} {:9.0f}%".format(
+            "{} edits".format(edits), sum(times) * 1000 / len(times), max(times) * 1000,
+            corrected * 100 / len(words)))
+
+
+def bench_cache(idx, queries):
+    """Measure the searches repeating some queries, with and without the results cache.
+
+    The queries are repeated with a skewed frequency, like the popular ones in a server.
+    """
+    all_keys = [keys for name, group in queries for keys in group]
+    # log-uniform ranks, so the first queries are much more frequent
+    repeated = [all_keys[int(len(all_keys) ** random.random()) - 1]
+                for _ in range(len(all_keys) * 5)]
+    print("{:>35} {:>12} {:>10} {:>10} {:>10}".format(
+        "", "time (ms)", "hits", "evictions", "size (KB)"))
+    for name, size in (("No cache", 0), ("Cache of 64 KB", 64 * 1024),
+                       ("Cache of 4 MB", 4 * 1024 ** 2)):
+        idx.cache = QueryCache(size)
+        initial_time = timeit.default_timer()
+        for keys in repeated:
+            list(idx.search(keys))
+        total_time = timeit.default_timer() - initial_time
+        stats = idx.cache.stats()
+        print("{:>35} {:12.2f} {:9.0f}% {:10} {:10.1f}".format(
+            name, total_time * 1000 / len(repeated), stats['hits'] * 100 / len(repeated),
+            stats['evictions'], stats['bytes'] / 1024))
+    idx.cache = QueryCache(0)
+
+
+BENCHMARKS = {
+    'cache': bench_cache,
+    'fuzzy': bench_fuzzy,
+    'lookups': bench_lookups,
+    'ngrams': bench_ngrams,
+    'memory': bench_memory,
+    'skips': bench_skips,
+    'threads': bench_threads,
+}
+
+
+if __name__ == "__main__":
+    help = """Benchmark the search in an index.
+
+    Uses ./idx as default path to index."""
+
+    parser = argparse.ArgumentParser(description=help)
+    parser.add_argument('-p', '--path', dest='path',
+                        default="./idx", help="Index's db path")
+    parser.add_argument('-q', '--quantity', dest='quantity', type=int,
+                        default=20, help="Quantity of queries in each group")
+    parser.add_argument('-s', '--seed', dest='seed', type=int,
+                        default=0, help="Seed for the random queries")
+    # the choices are checked after parsing, as argparse rejects an empty list of them
+    parser.add_argument('benchmarks', metavar='benchmark', nargs='*', default=None,
+                        help="Benchmarks to run: {} (default: all)".format(
+                            ", ".join(sorted(BENCHMARKS))))
+    args = parser.parse_args()
+    benchmarks = args.benchmarks or sorted(BENCHMARKS)
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("invalid benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    random.seed(args.seed)
+    # the results are not cached, to measure every search
+    idx = Index(args.path, cache_size=0)
+    words = list(idx.keys())
+    size = os.path.getsize(os.path.join(args.path, "index.sqlite"))
+    print("Index with {} words and {} documents, {:.1f} MB".format(
+        len(words), len(idx), size / 1024 ** 2))
+    queries = get_queries(words, args.quantity)
+    for benchmark in benchmarks:
+        print("\n== {}".format(benchmark))
+        BENCHMARKS[benchmark](idx, queries)